@@ -1,11 +1,10 @@
-import os, uuid, shutil, asyncio, aiohttp, time, aiofiles, subprocess, orjson, sys, subprocess
+import os, re, uuid, shutil, asyncio, atexit, aiohttp, time, subprocess, orjson, sys, subprocess, threading, memory, load_control, search_index, ollama_supervisor, session_store, tracing, usage_store
 from datetime import datetime
 from copy import deepcopy
+from contextlib import ExitStack
 
 try: import aiohttp
 except ImportError: subprocess.check_call([sys.executable, "-m", "pip", "install", "aiohttp"])
-try: import aiofiles
-except ImportError: subprocess.check_call([sys.executable, "-m", "pip", "install", "aiofiles"])
 try: import orjson
 except ImportError: subprocess.check_call([sys.executable, "-m", "pip", "install", "orjson"])
 
@@ -18,8 +17,7 @@ MODELS_DATA_JSON = os.path.join(MODELS_DIR, "models_data.json")
 
 ACTIVE_DIR = os.path.join(BASE_DIR, "active_chats")
 ARCHIVE_DIR = os.path.join(BASE_DIR, "archived_chats")
-
-API_URL = "http://localhost:11434/api/chat"
+BATCH_DATA_DIR = os.path.join(BASE_DIR, "batch_data")   # batch mode keeps its sessions away from the bot's
 
 SYSTEM_PROMPT_TEMPLATE = """
 You are a NSFW roleplay-focused AI character.
@@ -131,18 +129,69 @@ You may omit dialogue or actions if appropriate, but never break formatting rule
 Failure to follow these rules is considered a critical error.
 """
 
+# Branch transcripts reference their parent up to a turn instead of copying it. Parents record their branches,
+# so a branch can be flattened (parent's turns copied in) before the parent rewrites a turn the branch uses.
+BRANCHED_FROM = re.compile(r"=-=-=-=-=-=-= Branched from: (?P<session>[\w-]+) at turn (?P<turn>\d+) =-=-=-=-=-=-=")
+BRANCH_CREATED = re.compile(r"=-=-=-=-=-=-= Branch: (?P<session>[\w-]+) at turn (?P<turn>\d+) =-=-=-=-=-=-=")
+REGENERATED = "=-=-=-=-=-=-= Reply regenerated =-=-=-=-=-=-="
+MAX_BRANCH_DEPTH = 4    # longer chains are flattened when read
+FLUSH_INTERVAL = 2      # seconds, session metadata changes are written at most this late
+JOURNAL_COMPACT_ENTRIES = 50_000  # journal lines before it's folded into users_sessions.json
+
+MODELFILE_PARAMETERS = ("temperature", "top_p", "repeat_penalty", "num_ctx")  # PARAMETER lines of template.modelfile
+
+# Group scenes are stored as sessions of this pseudo-model, their transcript names the characters taking part
+GROUP_MODEL = "Group"
+GROUP_MEMBERS = re.compile(r"=-=-=-=-=-=-= Group: (?P<members>.+) =-=-=-=-=-=-=")
+GROUP_MAX_MEMBERS = 4         # each reply is its own embed
+GROUP_CONTEXT_TOKENS = 6000   # shared history sent to each character, oldest turns are left out above it
+GROUP_REPLY_ROOM = 2048       # part of the characters' num_ctx kept for their prompt and reply
+CHARS_PER_TOKEN = 4           # rough estimate, Ollama has no tokenize endpoint
+GROUP_TURN_PROMPT = """{user_input}
+
+(Group scene with {members}. Characters' messages are prefixed with their names. Reply only as {name}, without the name prefix.)"""
+
 os.makedirs(GENERATED_DIR, exist_ok=True)
-user_sessions = {}
+user_sessions = session_store.Session_Store()
+characters = {}             # {name: config with rendered system prompt}, filled by build_models
+shared_base_model = False   # characters run on one Ollama model with the prompt per request, instead of one model each
+_chat_locks = [threading.RLock() for _ in range(64)]
+_save_lock = threading.Lock()
+_journal_entries = 0
+_flush_task = None
+_migrated_dirs = set()  # (base dir, model) with no flat-layout transcripts left
+_migration_thread = None
 
 # ---------------------------
 # UTILITIES
 # ---------------------------
-def discord_ts():
-    return f"<t:{int(time.time())}:R>"
+def discord_ts(ts=None):
+    "Relative Discord timestamp of `ts` (Unix epoch, default: now). Only for display, sessions store the number."
+    return f"<t:{int(time.time() if ts is None else ts)}:R>"
+
+def _shard_path(base, model, name):
+    "Transcripts are nested by the first characters of the session ID: <model>/ab/cd/abcd....txt"
+    return os.path.join(base, model, name[:2], name[2:4], f"{name}.txt")
 
 def _chat_path(model, session_id, archived=False):
     base = ARCHIVE_DIR if archived else ACTIVE_DIR
-    return os.path.join(base, model, f"{session_id}.txt")
+    path = _shard_path(base, model, session_id)
+    # Old flat layout, until the migrator has moved everything out of the model's directory
+    if (base, model) not in _migrated_dirs and not os.path.exists(path):
+        flat_path = os.path.join(base, model, f"{session_id}.txt")
+        if os.path.exists(flat_path): return flat_path
+    return path
+
+def _chat_lock(session_id):
+    "Lock for the session's transcript, shared with the migrator so a file isn't moved while in use."
+    return _chat_locks[hash(session_id) % len(_chat_locks)]
+
+def _chain_lock(session_ids):
+    "Holds the locks of several transcripts, taken in a fixed order so two threads can't wait on each other."
+    stack = ExitStack()
+    for index in sorted({hash(session_id) % len(_chat_locks) for session_id in session_ids}):
+        stack.enter_context(_chat_locks[index])
+    return stack
 
 # ---------------------------
 # INIT
@@ -151,30 +200,56 @@ def init_sessions():
     global user_sessions
     os.makedirs(ACTIVE_DIR, exist_ok=True)
     os.makedirs(ARCHIVE_DIR, exist_ok=True)
-    if os.path.exists(DATA_FILE):
-        try:
-            with open(DATA_FILE, "rb") as f:
-                user_sessions = orjson.loads(f.read())
-        except:
-            user_sessions = {}
-    else:
-        user_sessions = {}
+    try:
+        data = _read_sessions()
+        user_sessions = session_store.Session_Store.from_json(data)
+        # Journal of the last run is merged into users_sessions.json now, before anything is written to it
+        if os.path.exists(_journal_path()):
+            _save_sessions(data)
+            os.remove(_journal_path())
+    except:
+        user_sessions = session_store.Session_Store()
     
     build_models()
+    start_layout_migration()
+
+def _migrate_layout():
+    "Moves flat-layout transcripts into shard directories, one at a time, while the bot keeps running."
+    for base in (ACTIVE_DIR, ARCHIVE_DIR):
+        for model in sorted(os.listdir(base)) if os.path.isdir(base) else []:
+            model_dir = os.path.join(base, model)
+            if not os.path.isdir(model_dir): continue
+            with os.scandir(model_dir) as entries:
+                flat = [e.name[:-4] for e in entries if e.is_file() and e.name.endswith(".txt")]
+            done = True
+            for name in flat:
+                with _chat_lock(name):
+                    src = os.path.join(model_dir, f"{name}.txt")
+                    dst = _shard_path(base, model, name)
+                    if not os.path.exists(src): continue
+                    if os.path.exists(dst):
+                        # In both layouts, shouldn't happen; left for manual merging, flat paths stay resolvable
+                        done = False
+                        continue
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    os.replace(src, dst)
+            if done: _migrated_dirs.add((base, model))
+
+def start_layout_migration():
+    global _migration_thread
+    if _migration_thread and _migration_thread.is_alive(): return
+    _migration_thread = threading.Thread(target=_migrate_layout, name="transcript-migration", daemon=True)
+    _migration_thread.start()
 
 def load_json(path: str):
     with open(path, "rb") as f:
         return orjson.loads(f.read())
 
-def build_models():
-    data = load_json(MODELS_DATA_JSON)
+def render_characters(data: dict) -> dict:
+    "Merges each character over the base config and renders its system prompt. Returns {name: config}."
     base_config = data.get("base", {})
-    models = data.get("models", {})
-
-    with open(TEMPLATE_PATH, "r", encoding="utf-8") as f:
-        template = f.read()
-
-    for name, model_data in models.items():
+    characters = {}
+    for name, model_data in data.get("models", {}).items():
         if not isinstance(model_data, dict):
             raise TypeError(f"Model '{name}' must be a dict, got {type(model_data).__name__}")
 
@@ -201,6 +276,27 @@ def build_models():
         for k, v in model_data.items():
             config[k] = v  # overwrite base
 
+        characters[name] = config
+    return characters
+
+def build_models():
+    global characters, shared_base_model
+    data = load_json(MODELS_DATA_JSON)
+    load_control.controller.configure(data.get("load", {}))
+    characters = render_characters(data)
+    shared_base_model = bool(data.get("base", {}).get("shared_base_model"))
+    light_models = set()
+
+    if shared_base_model:
+        # Characters are only system prompts sent with each request, nothing to create in Ollama
+        load_control.controller.light_models = {name + load_control.LIGHT_SUFFIX for name, config in characters.items()
+                                                if config.get("light_base_model")}
+        return
+
+    with open(TEMPLATE_PATH, "r", encoding="utf-8") as f:
+        template = f.read()
+
+    for name, config in characters.items():
         # Generate modelfile content
         try:
             modelfile_content = template.format(**config)
@@ -219,184 +315,643 @@ def build_models():
             stderr=subprocess.DEVNULL,
         )
 
+        # Lighter variant (e.g. smaller quantization), used under heavy load
+        if config.get("light_base_model"):
+            light_name = name + load_control.LIGHT_SUFFIX
+            light_path = os.path.join(GENERATED_DIR, f"{light_name}.modelfile")
+            with open(light_path, "w", encoding="utf-8") as f:
+                f.write(template.format(**{**config, "base_model": config["light_base_model"]}))
+            subprocess.Popen(
+                ["ollama", "create", light_name, "-f", light_path],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            light_models.add(light_name)
+
+    load_control.controller.light_models = light_models
+
+def _shared_request(target, messages):
+    """
+    With "shared_base_model", the character's cached system prompt goes with the request to the base model.
+    Returns (Ollama model, messages, options from the character config).
+    """
+    name = target.removesuffix(load_control.LIGHT_SUFFIX)
+    config = characters.get(name) if shared_base_model else None
+    if config is None: return target, messages, {}
+    model = config["light_base_model"] if target != name else config["base_model"]
+    options = {k: config[k] for k in MODELFILE_PARAMETERS if k in config}
+    if config.get("system_prompt"):
+        messages = [{"role":"system","content":config["system_prompt"]}] + messages
+    return model, messages, options
+
 # ---------------------------
 # DISK HELPERS
 # ---------------------------
-def _save_sessions():
-    """Save the current in-memory sessions to disk."""
-    with open(DATA_FILE, "wb") as f:
-        f.write(orjson.dumps(user_sessions, option=orjson.OPT_INDENT_2))
+def _journal_path():
+    "Changes of sessions since users_sessions.json was last written, one JSON line per changed session."
+    return os.path.splitext(DATA_FILE)[0] + ".journal"
 
+def _read_sessions():
+    "users_sessions.json with the journal applied."
+    data = {}
+    if os.path.exists(DATA_FILE):
+        with open(DATA_FILE, "rb") as f:
+            data = orjson.loads(f.read())
+    if os.path.exists(_journal_path()):
+        with open(_journal_path(), "rb") as f:
+            entries = []
+            for line in f:
+                try: entries.append(orjson.loads(line))
+                except orjson.JSONDecodeError: pass  # last line cut off by a crash
+        session_store.Session_Store.apply_journal(data, entries)
+    return data
+
+def _save_sessions(data=None):
+    """Save the current in-memory sessions (or `data`, their snapshot made with `to_json`) to disk."""
+    if data is None: data = user_sessions.to_json()
+    with _save_lock:
+        # Written next to the file and swapped in, so a crash mid-write doesn't leave it cut off
+        tmp_path = DATA_FILE + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_path, DATA_FILE)
+
+def _append_journal(entries):
+    "Appends changed sessions to the journal, folding it into users_sessions.json once it gets long."
+    global _journal_entries
+    with _save_lock:
+        with open(_journal_path(), "ab") as f:
+            f.write(b"".join(orjson.dumps(entry) + b"\n" for entry in entries))
+        _journal_entries += len(entries)
+        if _journal_entries < JOURNAL_COMPACT_ENTRIES: return
+        # Done from the files, so the live store isn't read outside the event loop
+        data = _read_sessions()
+        tmp_path = DATA_FILE + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_path, DATA_FILE)
+        os.remove(_journal_path())
+        _journal_entries = 0
+
+@tracing.traced()
 def _ensure_chat(model, session_id):
-    path = _chat_path(model, session_id)
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    if not os.path.exists(path):
+    "Creates the transcript with its header if it doesn't exist yet. Returns its path."
+    with _chat_lock(session_id):
+        path = _chat_path(model, session_id)
+        try: f = open(path, "x", encoding="utf-8")
+        except FileExistsError: return path
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            f = open(path, "x", encoding="utf-8")
         now = datetime.now().strftime("%d-%m-%Y  %H:%M.%S")
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(f"=-=-=-=-=-=-= Session started: {now} =-=-=-=-=-=-=\n\n")
-
-def _append_chat(model, session_id, user_msg, ai_msg):
-    path = _chat_path(model, session_id)
-    if not os.path.exists(path):
-        _ensure_chat(model, session_id)
-    with open(path, "a", encoding="utf-8") as f:
-        f.write(f"User: {user_msg}\n{model}: {ai_msg}\n")
-
-def _load_history(model, session_id):
-    path = _chat_path(model, session_id)
-    if not os.path.exists(path): return []
+        with f: f.write(f"=-=-=-=-=-=-= Session started: {now} =-=-=-=-=-=-=\n\n")
+        return path
+
+@tracing.traced()
+def _append_chat(model, session_id, user_msg, ai_msg, user_id=None, regenerated=False):
+    with _chat_lock(session_id):
+        with open(_ensure_chat(model, session_id), "a", encoding="utf-8") as f:
+            # Transcripts are only appended to, regenerating a reply marks the previous turn as dropped
+            if regenerated: f.write(f"{REGENERATED}\n")
+            f.write(f"User: {user_msg}\n{model}: {ai_msg}\n")
+    if user_id is not None: search_index.add_turn(user_id, model, session_id, user_msg, ai_msg)
+
+def _parse_chat(model, session_id, depth=0, chain_ids=None):
+    """
+    Reads the transcript, resolving the parent chain of branches.
+    Returns (messages, branches of this session as [(session_id, turn)], length of the parent chain).
+    If `chain_ids` list is given, IDs of the session and its parents are added to it.
+    """
+    if chain_ids is not None: chain_ids.append(session_id)
+    with _chat_lock(session_id):
+        path = _chat_path(model, session_id)
+        if not os.path.exists(path): path = _chat_path(model, session_id, archived=True)
+        if not os.path.exists(path): return [], [], depth
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
     prefix_user, prefix_ai = "User: ", f"{model}: "
     len_u, len_a = len(prefix_user), len(prefix_ai)
-    msgs=[]
-    with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            line=line.rstrip()
-            if line.startswith(prefix_user): msgs.append({"role":"user","content":line[len_u:]})
-            elif line.startswith(prefix_ai): msgs.append({"role":"assistant","content":line[len_a:]})
+    msgs, branches, chain = [], [], depth
+    for line in lines:
+        line=line.rstrip()
+        if line.startswith(prefix_user): msgs.append({"role":"user","content":line[len_u:]})
+        elif line.startswith(prefix_ai): msgs.append({"role":"assistant","content":line[len_a:]})
+        elif line == REGENERATED: del msgs[-2:]
+        elif match := BRANCHED_FROM.fullmatch(line):
+            parent, _, chain = _parse_chat(model, match["session"], depth+1, chain_ids)
+            msgs = parent[:int(match["turn"])*2]
+        elif match := BRANCH_CREATED.fullmatch(line):
+            branches.append((match["session"], int(match["turn"])))
+    return msgs, branches, chain
+
+@tracing.traced()
+def _load_history(model, session_id):
+    msgs, branches, chain = _parse_chat(model, session_id)
+    if chain > MAX_BRANCH_DEPTH:
+        msgs = _flatten_branch(model, session_id)
     return msgs
 
-def _archive_chat(model, session_id):
-    path = _chat_path(model, session_id)
-    if not os.path.exists(path): return
-    end_time = datetime.now().strftime("%d-%m-%Y  %H:%M.%S")
-    with open(path, "a", encoding="utf-8") as f:
-        f.write(f"\n=-=-=-=-=-=-= Session ended: {end_time} =-=-=-=-=-=-=\n")
-    arch_dir = os.path.join(ARCHIVE_DIR, model)
-    os.makedirs(arch_dir, exist_ok=True)
-    arch_path = os.path.join(arch_dir, f"{session_id}.txt")
-    if os.path.exists(arch_path):
-        arch_path = os.path.join(arch_dir, f"{session_id}_{int(time.time())}.txt")
-    shutil.move(path, arch_path)
-
-async def remove_trailing_user_if_no_ai(model: str, session_id: str) -> bool:
-    path = _chat_path(model, session_id)
-    if not os.path.exists(path):
-        return False
-
-    user_prefix = "User: "
-    async with aiofiles.open(path, "r", encoding="utf-8") as f:
-        lines = await f.readlines()
-
-    if not lines: return False
+def _flatten_branch(model, session_id):
+    """
+    Reads the branch again and flattens it while holding the locks of its whole parent chain, so no turn appended
+    in between is lost. Returns its messages.
+    """
+    chain_ids = []
+    _parse_chat(model, session_id, chain_ids=chain_ids)
+    with _chain_lock(chain_ids):
+        msgs, branches, _ = _parse_chat(model, session_id)
+        _flatten_chat(model, session_id, msgs, branches)
+    return msgs
 
-    # Remove trailing empty lines
-    while lines and lines[-1].strip() == "":
-        lines.pop()
+def _flatten_chat(model, session_id, msgs, branches):
+    "Rewrites a branch transcript with its resolved history, so it no longer depends on its parents."
+    with _chat_lock(session_id):
+        path = _chat_path(model, session_id)
+        if not os.path.exists(path): return
+        with open(path, "r", encoding="utf-8") as f:
+            started = f.readline()
+        lines = [started, "\n"]
+        for msg in msgs:
+            lines.append(f"User: {msg['content']}\n" if msg["role"] == "user" else f"{model}: {msg['content']}\n")
+        lines.extend(f"=-=-=-=-=-=-= Branch: {branch} at turn {turn} =-=-=-=-=-=-=\n" for branch, turn in branches)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        os.replace(tmp_path, path)
+
+def _detach_branches(model, session_id, from_turn):
+    "Flattens branches that use turn `from_turn` or later of the session, before that turn is rewritten."
+    _, branches, _ = _parse_chat(model, session_id)
+    for branch, turn in branches:
+        if turn >= from_turn and os.path.exists(_chat_path(model, branch)):
+            _flatten_branch(model, branch)
+
+def _create_branch(model, session_id, parent_id, turn):
+    path = _chat_path(model, session_id)  # new sessions always go to the sharded layout
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    now = datetime.now().strftime("%d-%m-%Y  %H:%M.%S")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"=-=-=-=-=-=-= Session started: {now} =-=-=-=-=-=-=\n\n")
+        f.write(f"=-=-=-=-=-=-= Branched from: {parent_id} at turn {turn} =-=-=-=-=-=-=\n")
+    with _chat_lock(parent_id), open(_chat_path(model, parent_id), "a", encoding="utf-8") as f:
+        f.write(f"=-=-=-=-=-=-= Branch: {session_id} at turn {turn} =-=-=-=-=-=-=\n")
+
+@tracing.traced()
+def _archive_chat(model, session_id, user_id=None):
+    with _chat_lock(session_id):
+        path = _chat_path(model, session_id)
+        if not os.path.exists(path): return
+        if user_id is not None: search_index.mark_archived(user_id, model, session_id)
+        end_time = datetime.now().strftime("%d-%m-%Y  %H:%M.%S")
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(f"\n=-=-=-=-=-=-= Session ended: {end_time} =-=-=-=-=-=-=\n")
+        arch_path = _shard_path(ARCHIVE_DIR, model, session_id)
+        if os.path.exists(arch_path):
+            arch_path = _shard_path(ARCHIVE_DIR, model, f"{session_id}_{int(time.time())}")
+        os.makedirs(os.path.dirname(arch_path), exist_ok=True)
+        shutil.move(path, arch_path)
+
+def _remove_trailing_user(model, session_id):
+    with _chat_lock(session_id):
+        path = _chat_path(model, session_id)
+        if not os.path.exists(path):
+            return False
+
+        user_prefix = "User: "
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+
+        if not lines: return False
+
+        # Remove trailing empty lines
+        while lines and lines[-1].strip() == "":
+            lines.pop()
+
+        if not lines: return False
+
+        if lines[-1].lstrip().startswith(user_prefix):
+            lines.pop()
+            with open(path, "w", encoding="utf-8") as f:
+                f.writelines(lines)
+            return True
 
-    if not lines: return False
+        return False
 
-    if lines[-1].lstrip().startswith(user_prefix):
-        lines.pop()
-        async with aiofiles.open(path, "w", encoding="utf-8") as f:
-            await f.writelines(lines)
-        return True
+async def remove_trailing_user_if_no_ai(model: str, session_id: str) -> bool:
+    return await asyncio.to_thread(_remove_trailing_user, model, session_id)
 
-    return False
+def _ensure_group_chat(session_id, members):
+    with _chat_lock(session_id):
+        path = _chat_path(GROUP_MODEL, session_id)
+        if os.path.exists(path): return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        now = datetime.now().strftime("%d-%m-%Y  %H:%M.%S")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"=-=-=-=-=-=-= Session started: {now} =-=-=-=-=-=-=\n\n")
+            f.write(f"=-=-=-=-=-=-= Group: {', '.join(members)} =-=-=-=-=-=-=\n")
+
+@tracing.traced()
+def _append_group_turn(session_id, user_msg, replies, user_id=None):
+    "Appends the user's message and every character's reply to it, in one write."
+    with _chat_lock(session_id), open(_chat_path(GROUP_MODEL, session_id), "a", encoding="utf-8") as f:
+        f.write(f"User: {user_msg}\n" + "".join(f"{name}: {reply}\n" for name, reply in replies.items()))
+    if user_id is not None:
+        search_index.add_turn(user_id, GROUP_MODEL, session_id, user_msg, "\n".join(replies.values()))
+
+@tracing.traced()
+def _parse_group_chat(session_id):
+    """
+    Returns (characters, messages) of a group transcript. Characters' messages are {"role": "assistant",
+    "name": character, "content": ...}, one per character per turn.
+    """
+    with _chat_lock(session_id):
+        path = _chat_path(GROUP_MODEL, session_id)
+        if not os.path.exists(path): return [], []
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+    members, prefixes, msgs = [], [], []
+    for line in lines:
+        line = line.rstrip()
+        if line.startswith("User: "): msgs.append({"role":"user","content":line[6:]})
+        elif match := GROUP_MEMBERS.fullmatch(line):
+            members = match["members"].split(", ")
+            # Longest first, so a name that starts with another name isn't cut
+            prefixes = sorted(((f"{name}: ", name) for name in members), key=lambda p: -len(p[0]))
+        else:
+            for prefix, name in prefixes:
+                if line.startswith(prefix):
+                    msgs.append({"role":"assistant","name":name,"content":line[len(prefix):]})
+                    break
+    return members, msgs
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def _group_prefix(hist, budget=GROUP_CONTEXT_TOKENS):
+    """
+    Renders the shared history once per turn: the same messages go to every character, so the prefix is built
+    and counted once instead of per character. Returns (messages, estimated tokens).
+    """
+    rendered, tokens = [], 0
+    for msg in reversed(hist):
+        content = msg["content"] if msg["role"] == "user" else f"{msg['name']}: {msg['content']}"
+        cost = estimate_tokens(content)
+        if tokens + cost > budget: break
+        rendered.append({"role":msg["role"],"content":content})
+        tokens += cost
+    rendered.reverse()
+    # Start at a user message, not in the middle of a turn
+    while rendered and rendered[0]["role"] != "user":
+        tokens -= estimate_tokens(rendered.pop(0)["content"])
+    return rendered, tokens
 
 # ---------------------------
 # ASYNC WRAPPERS
 # ---------------------------
-async def save_sessions(): await asyncio.to_thread(_save_sessions)
 async def ensure_chat_async(model, session_id): await asyncio.to_thread(_ensure_chat, model, session_id)
-async def append_chat_async(model, session_id, user_msg, ai_msg): await asyncio.to_thread(_append_chat, model, session_id, user_msg, ai_msg)
+async def append_chat_async(model, session_id, user_msg, ai_msg, user_id=None, regenerated=False): await asyncio.to_thread(_append_chat, model, session_id, user_msg, ai_msg, user_id, regenerated)
 async def load_history_async(model, session_id): return await asyncio.to_thread(_load_history, model, session_id)
-async def archive_chat_async(model, session_id): await asyncio.to_thread(_archive_chat, model, session_id)
+async def load_group_async(session_id): return await asyncio.to_thread(_parse_group_chat, session_id)
+async def archive_chat_async(model, session_id, user_id=None): await asyncio.to_thread(_archive_chat, model, session_id, user_id)
 
-def ensure_user_model(user_id, model):
-    if user_id not in user_sessions: user_sessions[user_id]={}
-    if model not in user_sessions[user_id]: user_sessions[user_id][model]={}
+# ---------------------------
+# WRITE-BEHIND
+# ---------------------------
+def mark_dirty():
+    """
+    Session metadata changed. Changed sessions (tracked by the store) are appended to the journal by the flusher
+    within FLUSH_INTERVAL, so no reply waits for a write. Must be called from the event loop.
+    """
+    global _flush_task
+    loop = asyncio.get_running_loop()
+    if _flush_task is None or _flush_task.done() or _flush_task.get_loop() is not loop:
+        _flush_task = loop.create_task(_flusher())
+
+async def _flusher():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            await flush_sessions()
+        except Exception as e:
+            # Changes stay pending and are retried next time
+            print(f"[ERROR] Couldn't save sessions: {type(e).__name__}: {e}", file=sys.stderr)
+
+async def flush_sessions():
+    "Writes pending session changes (and buffered usage events) now. Call before shutting down."
+    await asyncio.to_thread(usage_store.store.flush)
+    changes = user_sessions.take_changes()
+    if not changes: return
+    # Only the changed records are serialized on the loop
+    entries = [session_store.Session_Store.journal_entry(record, removed) for record, removed in changes.values()]
+    try:
+        await asyncio.to_thread(_append_journal, entries)
+    except:
+        user_sessions.restore_changes(changes)
+        raise
+
+def _flush_at_exit():
+    "Last resort for changes still pending when the interpreter exits (e.g. the loop was stopped by an error)."
+    changes = user_sessions.take_changes()
+    if changes: _append_journal([session_store.Session_Store.journal_entry(record, removed) for record, removed in changes.values()])
+
+atexit.register(_flush_at_exit)
 
 # ---------------------------
 # LLM CALL
 # ---------------------------
-async def generate_llm_reply(model, messages, user_msg):
+def _trace_generation(sent, done, model):
+    "Adds Ollama's own timings (nanoseconds, from the final chunk) to the trace: model load, prefill and decoding."
+    load = (done.get("load_duration") or 0) / 1e6
+    prefill = (done.get("prompt_eval_duration") or 0) / 1e6
+    decode = (done.get("eval_duration") or 0) / 1e6
+    if load: tracing.record("ollama.load", sent, load, model=model)
+    tracing.record("ollama.prefill", sent + load / 1000, prefill, tokens=done.get("prompt_eval_count"))
+    tracing.record("ollama.decode", sent + (load + prefill) / 1000, decode, tokens=done.get("eval_count"))
+
+@tracing.traced()
+async def generate_llm_reply(model, messages, user_msg, on_chunk=None, meta=None, options=None):
+    """
+    `options` are extra /api/chat options, load control's reductions still apply over them.
+    A failed instance is retried on another one, raises ollama_supervisor.Ollama_Unavailable when no reply could be made.
+    """
     messages.append({"role":"user","content":user_msg})
+    request_options = options or {}
     parts=[]
-    async with aiohttp.ClientSession() as client:
-        try:
-            async with client.post(API_URL,json={"model":model,"messages":messages},timeout=None) as resp:
-                async for chunk in resp.content:
-                    try:
-                        data = orjson.loads(chunk)
-                        content = data.get("message",{}).get("content")
-                        if content: parts.append(content)
-                    except: continue
-        except: pass
+    controller = load_control.controller
+    supervisor = ollama_supervisor.supervisor
+    queued, queued_at, waiting = time.time(), time.perf_counter(), controller.waiting
+    tried = set()
+    async with controller.slot():
+        tracing.record("queue", queued, (time.perf_counter() - queued_at) * 1000, waiting=waiting)
+        # Under load replies get shorter and may come from a lighter model
+        target, level_options, level = controller.plan(model)
+        # A reduced context must stay below the character's own num_ctx, or it would grow instead
+        normal_ctx = characters.get(model, {}).get("num_ctx")
+        if "num_ctx" in level_options and normal_ctx:
+            level_options["num_ctx"] = min(level_options["num_ctx"], normal_ctx)
+        target, request_messages, character_options = _shared_request(target, messages)
+        while True:
+            async with supervisor.endpoint(tried) as (base_url, instance_options):
+                options = {**character_options, **instance_options, **request_options, **level_options}
+                payload = {"model":target,"messages":request_messages}
+                if options: payload["options"] = options
+                try:
+                    async with aiohttp.ClientSession() as client:
+                        sent = time.time()
+                        async with client.post(f"{base_url}/api/chat",json=payload,timeout=None) as resp:
+                            if resp.status != 200:
+                                raise ollama_supervisor.Ollama_Unavailable(f"Ollama answered {resp.status}: {(await resp.text())[:200]}")
+                            async for chunk in resp.content:
+                                try: data = orjson.loads(chunk)
+                                except orjson.JSONDecodeError: continue
+                                content = data.get("message",{}).get("content")
+                                if content:
+                                    parts.append(content)
+                                    if on_chunk: on_chunk(content)
+                                if data.get("done"):
+                                    controller.record(data.get("eval_count"), data.get("eval_duration"))
+                                    _trace_generation(sent, data, target)
+                                    if meta is not None: meta["prompt_tokens"], meta["reply_tokens"] = data.get("prompt_eval_count"), data.get("eval_count")
+                    break
+                except aiohttp.ClientConnectionError as e:
+                    supervisor.report_failure(base_url)
+                    tried.add(base_url)
+                    # Streamed parts were already shown, only a request that produced nothing can be retried
+                    if parts or len(tried) >= len(supervisor.instances):
+                        raise ollama_supervisor.Ollama_Unavailable(f"Ollama on {base_url} failed: {e}") from e
+                except aiohttp.ClientError as e:
+                    raise ollama_supervisor.Ollama_Unavailable(f"Ollama on {base_url} failed: {e}") from e
+    if meta is not None: meta["degraded"] = level > load_control.NORMAL
     reply="".join(parts)
+    if not reply:
+        raise ollama_supervisor.Ollama_Unavailable(f"{target} returned an empty reply")
     messages.append({"role":"assistant","content":reply})
     return reply
 
 # ---------------------------
 # SESSION API
 # ---------------------------
-async def start_session(user_id, model, session_id=None, session_name=None, auto_hi=True):
+@tracing.traced()
+async def start_session(user_id, model, session_id=None, session_name=None, auto_hi=True, on_chunk=None, meta=None):
     user_id = str(user_id)
-    ensure_user_model(user_id, model)
 
     if session_id:
         session_id = str(session_id)
-        if session_id in user_sessions[user_id][model]:
+        if user_sessions.get(user_id, model, session_id):
             return session_id, None
 
     session_id = str(uuid.uuid4())
     name = (session_name or "New Session").strip() or "New Session"
-    user_sessions[user_id][model][session_id] = [name, discord_ts()]
-    await save_sessions()
+    user_sessions.add(user_id, model, session_id, name)
+    mark_dirty()
+    usage_store.store.record(usage_store.SESSION_START, user_id, model)
     await ensure_chat_async(model, session_id)
+    await asyncio.to_thread(search_index.set_name, user_id, model, session_id, name)
 
     hi_reply = None
     if auto_hi:
-        hi_reply = await chat(user_id, model, session_id, '"Hi"')
+        hi_reply = await chat(user_id, model, session_id, '"Hi"', on_chunk, meta)
 
     return session_id, hi_reply
 
-async def chat(user_id, model, session_id, user_input):
-    user_id = str(user_id)
-    if user_id not in user_sessions or model not in user_sessions[user_id] or session_id not in user_sessions[user_id][model]:
-        raise ValueError("Session not found")
-    name,_ = user_sessions[user_id][model][session_id]
-    user_sessions[user_id][model][session_id]=[name, discord_ts()]
-    await save_sessions()
-    hist = await load_history_async(model,session_id)
-    reply = await generate_llm_reply(model,hist,user_input)
-    await append_chat_async(model,session_id,user_input,reply)
+async def _reply(user_id, model, session_id, hist, user_input, on_chunk, meta, regenerated=False):
+    "Generates a reply to `user_input` after `hist` and appends the turn to the transcript."
+    meta = {} if meta is None else meta
+    started = time.perf_counter()
+    context = await memory.build_context(model,session_id,hist,user_input)
+    reply = await generate_llm_reply(model,context,user_input,on_chunk,meta)
+    usage_store.store.record(usage_store.REGENERATE if regenerated else usage_store.REPLY, user_id, model, meta.get("prompt_tokens"),
+                             meta.get("reply_tokens"), (time.perf_counter() - started) * 1000, len(user_input.encode()) + len(reply.encode()))
+    await append_chat_async(model,session_id,user_input,reply,user_id,regenerated)
+    hist += context[-2:]
+    memory.remember(model,session_id,hist)
+    meta["turn"] = len(hist) // 2
     return reply
 
+@tracing.traced()
+async def chat(user_id, model, session_id, user_input, on_chunk=None, meta=None):
+    """
+    Generates a reply in the session and appends the turn to its transcript.
+    If `meta` dict is provided, it's filled with details of the generation ("degraded": bool, "turn": int,
+    "prompt_tokens" and "reply_tokens": int or None).
+    """
+    user_id = str(user_id)
+    record = user_sessions.get(user_id, model, session_id)
+    if record is None:
+        raise ValueError("Session not found")
+    # History is read in a thread meanwhile
+    loading = asyncio.create_task(load_history_async(model,session_id))
+    user_sessions.touch(record)
+    mark_dirty()
+    hist = await loading
+    return await _reply(user_id,model,session_id,hist,user_input,on_chunk,meta)
+
+@tracing.traced()
+async def regenerate(user_id, model, session_id, on_chunk=None, meta=None):
+    """
+    Replaces the last reply of the session with a new one. The request is the same as the one of the replaced
+    reply, so Ollama reuses the already evaluated prompt and only the reply is decoded again.
+    Returns (user message, new reply), or (None, None) if the session has no reply yet.
+    """
+    user_id = str(user_id)
+    record = user_sessions.get(user_id, model, session_id)
+    if record is None:
+        raise ValueError("Session not found")
+    # History is read in a thread meanwhile
+    loading = asyncio.create_task(load_history_async(model,session_id))
+    user_sessions.touch(record)
+    mark_dirty()
+    hist = await loading
+    if len(hist) < 2: return None, None
+    user_input = hist[-2]["content"]
+    hist = hist[:-2]
+    turn = len(hist) // 2
+    await asyncio.to_thread(_detach_branches, model, session_id, turn + 1)
+    await memory.truncate(model, session_id, turn)
+    reply = await _reply(user_id,model,session_id,hist,user_input,on_chunk,meta,regenerated=True)
+    return user_input, reply
+
+@tracing.traced()
+async def branch_session(user_id, model, session_id, turn=None, session_name=None):
+    """
+    Starts a new session continuing from `turn` of an existing one (default: its last turn).
+    The branch references the parent's transcript instead of copying it. Returns new session's ID, or None.
+    """
+    user_id = str(user_id)
+    parent = user_sessions.get(user_id, model, session_id)
+    if parent is None: return None
+    hist = await load_history_async(model, session_id)
+    turn = len(hist) // 2 if turn is None else min(turn, len(hist) // 2)
+    if turn < 1: return None
+
+    branch_id = str(uuid.uuid4())
+    name = (session_name or "").strip() or (parent.name if parent.name.endswith(" (branch)") else f"{parent.name} (branch)")
+    user_sessions.add(user_id, model, branch_id, name)
+    mark_dirty()
+    usage_store.store.record(usage_store.BRANCH, user_id, model)
+    await asyncio.to_thread(_create_branch, model, branch_id, session_id, turn)
+    await memory.copy(model, session_id, branch_id, turn)
+    await asyncio.to_thread(search_index.set_name, user_id, model, branch_id, name)
+    return branch_id
+
+@tracing.traced()
 async def end_session(user_id, model, session_id):
     user_id = str(user_id)
-    if user_id not in user_sessions or model not in user_sessions[user_id] or session_id not in user_sessions[user_id][model]: return False
-    await archive_chat_async(model, session_id)
-    del user_sessions[user_id][model][session_id]
-    if not user_sessions[user_id][model]: del user_sessions[user_id][model]
-    if not user_sessions[user_id]: del user_sessions[user_id]
-    await save_sessions()
+    if user_sessions.get(user_id, model, session_id) is None: return False
+    await archive_chat_async(model, session_id, user_id)
+    await memory.drop(model, session_id)
+    user_sessions.remove(user_id, model, session_id)
+    mark_dirty()
+    usage_store.store.record(usage_store.SESSION_END, user_id, model)
     return True
 
+@tracing.traced()
+async def start_group_session(user_id, members, session_name=None, auto_hi=True, meta=None):
+    """
+    Starts a scene with several characters. Returns (session ID, {character: first reply} or None).
+    """
+    user_id = str(user_id)
+    members = list(dict.fromkeys(members))
+    if not 2 <= len(members) <= GROUP_MAX_MEMBERS:
+        raise ValueError(f"Group needs 2 to {GROUP_MAX_MEMBERS} characters")
+    session_id = str(uuid.uuid4())
+    name = (session_name or "Group Scene").strip() or "Group Scene"
+    user_sessions.add(user_id, GROUP_MODEL, session_id, name)
+    mark_dirty()
+    usage_store.store.record(usage_store.SESSION_START, user_id, GROUP_MODEL)
+    await asyncio.to_thread(_ensure_group_chat, session_id, members)
+    await asyncio.to_thread(search_index.set_name, user_id, GROUP_MODEL, session_id, name)
+
+    replies = None
+    if auto_hi:
+        replies = await group_chat(user_id, session_id, '"Hi"', meta)
+    return session_id, replies
+
+@tracing.traced()
+async def group_chat(user_id, session_id, user_input, meta=None):
+    """
+    Every character of the group replies to `user_input`, generated concurrently (each still takes its own
+    load control slot). Returns {character: reply} in the group's order. `meta` is filled like in `chat`.
+    """
+    user_id = str(user_id)
+    record = user_sessions.get(user_id, GROUP_MODEL, session_id)
+    if record is None:
+        raise ValueError("Session not found")
+    loading = asyncio.create_task(load_group_async(session_id))
+    user_sessions.touch(record)
+    mark_dirty()
+    members, hist = await loading
+
+    # Characters keep the num_ctx of their solo chats (a different one makes Ollama reload the model), so the
+    # shared history is cut to fit the smallest of them
+    contexts = [characters[name]["num_ctx"] for name in members if characters.get(name, {}).get("num_ctx")]
+    budget = min([GROUP_CONTEXT_TOKENS] + [ctx - GROUP_REPLY_ROOM for ctx in contexts])
+    prefix, _ = _group_prefix(hist, max(budget, 0))
+    member_list = ", ".join(members)
+    metas = [{} for _ in members]
+    started = time.perf_counter()
+    try:
+        async with asyncio.TaskGroup() as group:
+            tasks = [group.create_task(generate_llm_reply(name, list(prefix), GROUP_TURN_PROMPT.format(user_input=user_input,
+                                                          members=member_list, name=name), meta=member_meta))
+                     for name, member_meta in zip(members, metas)]
+    except ExceptionGroup as e:
+        # The first failure cancels the other characters, so they don't keep their load control slots.
+        # Callers get it as raised (e.g. Ollama_Unavailable)
+        raise e.exceptions[0]
+    replies = [task.result() for task in tasks]
+    # Models sometimes still start with their name
+    replies = {name: reply.removeprefix(f"{name}: ") for name, reply in zip(members, replies)}
+    latency = (time.perf_counter() - started) * 1000
+    for (name, reply), member_meta in zip(replies.items(), metas):
+        usage_store.store.record(usage_store.GROUP_REPLY, user_id, name, member_meta.get("prompt_tokens"), member_meta.get("reply_tokens"),
+                                 latency, len(user_input.encode()) + len(reply.encode()))
+
+    await asyncio.to_thread(_append_group_turn, session_id, user_input, replies, user_id)
+    if meta is not None:
+        meta["degraded"] = any(m.get("degraded") for m in metas)
+        meta["turn"] = sum(1 for msg in hist if msg["role"] == "user") + 1
+    return replies
+
 async def list_sessions(user_id):
-    return user_sessions.get(str(user_id),{}).copy()
+    "Returns {model: {session_id: [name, last modified (Unix epoch)]}}"
+    return user_sessions.user_dict(user_id)
 
 async def rename_session(user_id, model, session_id, new_name):
     user_id=str(user_id)
-    if user_id not in user_sessions or model not in user_sessions[user_id] or session_id not in user_sessions[user_id][model]: return False
-    user_sessions[user_id][model][session_id][0]=new_name.strip() or user_sessions[user_id][model][session_id][0]
-    await save_sessions()
+    record = user_sessions.get(user_id, model, session_id)
+    if record is None: return False
+    user_sessions.rename(record, new_name.strip() or record.name)
+    mark_dirty()
+    await asyncio.to_thread(search_index.set_name, user_id, model, session_id, record.name)
     return True
 
 # ---------------------------
 # TERMINAL RUNNER
 # ---------------------------
-async def terminal_runner():
+async def start_ollama():
+    "Starts Ollama under the supervisor, tuned with the `ollama` section of models_data.json."
+    data = load_json(MODELS_DATA_JSON)
+    await ollama_supervisor.supervisor.start(data.get("ollama", {}), len(data.get("models", {})))
+    load_control.controller.set_capacity(ollama_supervisor.supervisor.capacity())
+
+async def terminal_runner(stream=False):
+    # Ollama has to be up before init_sessions creates the models
+    await start_ollama()
     init_sessions()
     os.system("cls")
-    subprocess.Popen(["ollama", "serve"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     user_id = "local"
     model = input("Model: ").strip()
     sess = input("Session ID (blank=new): ").strip() or None
     sess_name=None
     if sess is None:
         sess_name=input("Custom session name (blank=New Session): ").strip() or "New Session"
-    session_id,reply = await start_session(user_id,model,session_id=sess,session_name=sess_name)
-    print(f"{model}: {reply}\n")
+    # In stream mode reply is printed as it's generated, instead of after the whole reply is done
+    printer = (lambda part: print(part, end="", flush=True)) if stream else None
+
+    if stream: print(f"{model}: ", end="", flush=True)
+    session_id,reply = await start_session(user_id,model,session_id=sess,session_name=sess_name,on_chunk=printer)
+    print("\n" if stream else f"{model}: {reply}\n")
 
     # print("Start chatting. Type 'end' to archive, 'exit' to quit.\n")
     while True:
@@ -407,8 +962,110 @@ async def terminal_runner():
             ok=await end_session(user_id,model,session_id)
             print(f"Session {session_id} archived." if ok else "Failed to archive.")
             break
-        reply=await chat(user_id,model,session_id,user_text)
-        print(f"{model}: {reply}\n")
+        if stream: print(f"{model}: ", end="", flush=True)
+        try: reply=await chat(user_id,model,session_id,user_text,printer)
+        except ollama_supervisor.Ollama_Unavailable as e:
+            print(f"\n[ERROR] {e}\n")
+            continue
+        print("\n" if stream else f"{model}: {reply}\n")
+    await flush_sessions()
+    await ollama_supervisor.supervisor.stop()
+
+# ---------------------------
+# BATCH RUNNER
+# ---------------------------
+async def _run_batch_chain(chain, semaphore, write_result):
+    """
+    Runs turns of one (user, model, session) in order. Turns of different sessions run concurrently,
+    at most `parallel` at once. Unknown session values are used as names of new sessions.
+    """
+    session_id = None
+    for index, record in chain:
+        user_id, model = str(record["user"]), record["model"]
+        result = {"index": index, "user": user_id, "model": model, "session": record.get("session"), "message": record["message"]}
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                if session_id is None:
+                    # Only kept once the session exists, so a failed start is retried by the next turn
+                    session = str(record.get("session") or "")
+                    if user_sessions.get(user_id, model, session) is None:
+                        session,_ = await start_session(user_id, model, session_name=session or None, auto_hi=False)
+                    session_id = session
+                result["reply"] = await chat(user_id, model, session_id, record["message"], meta=result)
+            except Exception as e:
+                result["error"] = f"{type(e).__name__}: {e}"
+            result["seconds"] = round(time.perf_counter() - started, 3)
+        result["session_id"] = session_id
+        await write_result(result)
+
+def use_data_dir(path):
+    "Points sessions, transcripts, search and memory indexes and usage events to `path`, call before init_sessions."
+    global DATA_FILE, ACTIVE_DIR, ARCHIVE_DIR
+    os.makedirs(path, exist_ok=True)
+    DATA_FILE = os.path.join(path, "users_sessions.json")
+    ACTIVE_DIR = os.path.join(path, "active_chats")
+    ARCHIVE_DIR = os.path.join(path, "archived_chats")
+    search_index.INDEX_DIR = os.path.join(path, "search_index")
+    memory.MEMORY_DIR = os.path.join(path, "memory_index")
+    usage_store.use_dir(os.path.join(path, "usage"))
+
+async def batch_runner(input_path, output_path=None, parallel=4, data_dir=BATCH_DATA_DIR):
+    """
+    Headless mode. Reads JSONL records of {"user", "model", "session", "message"} and writes one JSONL
+    result per record (reply, session_id, seconds, error), in order of completion, to `output_path` or stdout.
+    Sessions are kept in `data_dir`, pass BASE_DIR to use the bot's own.
+    """
+    if os.path.abspath(data_dir) != BASE_DIR: use_data_dir(data_dir)
+    await start_ollama()
+    init_sessions()
+
+    chains, invalid = {}, []
+    with open(input_path, "rb") as f:
+        for index, line in enumerate(f):
+            if not line.strip(): continue
+            try:
+                record = orjson.loads(line)
+                key = (str(record["user"]), record["model"], str(record.get("session") or ""))
+                record["message"]
+            except (orjson.JSONDecodeError, KeyError, TypeError, AttributeError) as e:
+                invalid.append({"index": index, "error": f"Invalid record: {type(e).__name__}: {e}"})
+                continue
+            # Records without a session each get their own new session
+            if not key[2]: key += (index,)
+            chains.setdefault(key, []).append((index, record))
+
+    out = open(output_path, "ab") if output_path else sys.stdout.buffer
+    write_lock = asyncio.Lock()
+
+    async def write_result(result):
+        async with write_lock:
+            out.write(orjson.dumps(result) + b"\n")
+            out.flush()
+
+    semaphore = asyncio.Semaphore(max(parallel, 1))
+    started = time.perf_counter()
+    try:
+        for result in invalid: await write_result(result)
+        await asyncio.gather(*(_run_batch_chain(chain, semaphore, write_result) for chain in chains.values()))
+    finally:
+        if output_path: out.close()
+        await flush_sessions()
+        await ollama_supervisor.supervisor.stop()
+    print(f"Finished {sum(len(c) for c in chains.values())} turns in {time.perf_counter() - started:.1f}s"
+          + (f", skipped {len(invalid)} invalid records" if invalid else ""), file=sys.stderr)
 
 if __name__=="__main__":
-    asyncio.run(terminal_runner())
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="NBD AI terminal client")
+    parser.add_argument("--stream", action="store_true", help="print replies while they're generated")
+    parser.add_argument("--batch", metavar="INPUT", help="run JSONL records of {user, model, session, message} without prompting")
+    parser.add_argument("--output", metavar="OUTPUT", help="JSONL file for batch results (default: stdout)")
+    parser.add_argument("--parallel", type=int, default=4, help="turns generated at once in batch mode (default: 4)")
+    parser.add_argument("--data-dir", default=BATCH_DATA_DIR, help="where batch mode keeps its sessions (default: batch_data/, the bot's directory to use its sessions)")
+    args = parser.parse_args()
+
+    if args.batch:
+        asyncio.run(batch_runner(args.batch, args.output, args.parallel, args.data_dir))
+    else:
+        asyncio.run(terminal_runner(args.stream))
@@ -0,0 +1,212 @@
+"""
+Storage micro-benchmarks at realistic scale.
+
+Generates synthetic sessions and transcripts in a temporary directory and times storage and UI-path functions
+of AI.py and support.py one by one. Reports time and peak memory per operation and saves the results as JSON
+in benchmarks/results/, so runs can be compared over time.
+
+    python benchmarks/storage_bench.py
+    python benchmarks/storage_bench.py --users 10000 100000 1000000 --turns 10 100 1000 5000
+    python benchmarks/storage_bench.py --baseline benchmarks/results/storage-20260101-120000.json
+"""
+import os, sys, gc, time, uuid, random, shutil, asyncio, argparse, platform, statistics, tempfile, tracemalloc, orjson
+from datetime import datetime
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(BASE_DIR, "benchmarks", "results")
+sys.path.insert(0, BASE_DIR)
+
+import AI, support, session_store, search_index, memory, usage_store
+
+MODELS = ("Riley", "Renamon", "Cwel")
+LOOP = asyncio.new_event_loop()  # one loop for all async operations, so loop startup isn't timed
+WORDS = "the fox leans against wall arms crossed eyes narrowing slowly smiles quietly looks away hey there".split()
+
+# ---------------------------
+# SYNTHETIC DATA
+# ---------------------------
+def _sentence(rng: random.Random, words: int = 30) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+def build_sessions_json(users: int, sessions: tuple[int, int], rng: random.Random) -> bytes:
+    """
+    users_sessions.json content. Sessions per user are drawn from the `sessions` range with a long tail:
+    most users have a few, some have many.
+    """
+    data = {}
+    now = time.time()
+    low, high = sessions
+    for user in range(users):
+        models = data[str(10**17 + user)] = {}
+        for n in range(low + int((high - low) * rng.random() ** 3)):
+            models.setdefault(MODELS[n % len(MODELS)], {})[str(uuid.UUID(int=rng.getrandbits(128)))] = [f"Session {n}", int(now - rng.random() * 90*86400)]
+    return orjson.dumps(data)
+
+def write_transcript(path: str, model: str, turns: int, rng: random.Random, trailing_user: bool = False) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("=-=-=-=-=-=-= Session started: 01-01-2026  00:00.00 =-=-=-=-=-=-=\n\n")
+        for _ in range(turns):
+            f.write(f"User: {_sentence(rng, 15)}\n{model}: {_sentence(rng, 60)}\n")
+        if trailing_user: f.write(f"User: {_sentence(rng, 15)}\n")
+
+# ---------------------------
+# MEASURING
+# ---------------------------
+def measure(name: str, scale: str, fn, repeat: int, setup=None) -> dict:
+    """
+    Times `fn` `repeat` times (after `setup`, which isn't timed), then runs it once more under tracemalloc
+    for peak memory. Coroutine functions are run to completion.
+    """
+    def call():
+        result = fn()
+        if asyncio.iscoroutine(result): LOOP.run_until_complete(result)
+
+    times = []
+    for _ in range(repeat):
+        if setup: setup()
+        started = time.perf_counter()
+        call()
+        times.append((time.perf_counter() - started) * 1000)
+
+    if setup: setup()
+    tracemalloc.start()
+    call()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {"op": name, "scale": scale, "runs": repeat, "median_ms": round(statistics.median(times), 3),
+              "min_ms": round(min(times), 3), "max_ms": round(max(times), 3), "peak_kb": round(peak / 1024, 1)}
+    print(f"{name:<38}{scale:<22}{result['median_ms']:>12.3f} ms{result['peak_kb']:>14.1f} KB", flush=True)
+    return result
+
+def measure_store_memory(raw: bytes, scale: str) -> tuple[dict, session_store.Session_Store]:
+    """
+    Bytes per session held by the store loaded from users_sessions.json content `raw`, next to the same sessions
+    kept as the plain parsed JSON. Returns (result, the loaded store).
+    """
+    gc.collect()
+    tracemalloc.start()
+    data = orjson.loads(raw)
+    plain = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    count = sum(len(sessions) for models in data.values() for sessions in models.values())
+    del data
+
+    gc.collect()
+    tracemalloc.start()
+    store = session_store.Session_Store.from_json(orjson.loads(raw))
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    result = {"op": "Session_Store memory", "scale": scale, "sessions": count,
+              "bytes_per_session": round(held / count, 1), "json_bytes_per_session": round(plain / count, 1)}
+    print(f"{result['op']:<38}{scale:<22}{result['bytes_per_session']:>11.1f} B/session  (plain JSON {result['json_bytes_per_session']:.1f})", flush=True)
+    return result, store
+
+# ---------------------------
+# BENCHMARKS
+# ---------------------------
+def bench_sessions(users: int, sessions: tuple[int, int], repeat: int, rng: random.Random) -> list[dict]:
+    "Operations whose cost grows with the number of users and sessions. UI paths are timed for the user with most sessions."
+    scale = f"{users} users x {sessions[0]}-{sessions[1]}"
+    memory_result, AI.user_sessions = measure_store_memory(build_sessions_json(users, sessions, rng), scale)
+    user_id = max(AI.user_sessions.users, key=lambda user: sum(map(len, AI.user_sessions.users[user].values())))
+    user_dict = AI.user_sessions.user_dict(user_id)
+    model = next(iter(user_dict))
+    session_id = next(iter(user_dict[model]))
+
+    results = [
+        memory_result,
+        measure("AI._save_sessions", scale, AI._save_sessions, repeat),
+        # What a chat turn costs: one touched session journaled, nothing else serialized
+        measure("AI.flush_sessions", scale, AI.flush_sessions, repeat, lambda: AI.user_sessions.touch(AI.user_sessions.get(user_id, model, session_id))),
+        measure("support.get_user_sessions", scale, lambda: support.get_user_sessions(user_id), repeat),
+        measure("support.split_sessions_into_pages", scale, lambda: support.split_sessions_into_pages(user_dict), repeat),
+        measure("support.get_session_id_by_number", scale, lambda: support.get_session_id_by_number(user_id, model, "1"), repeat),
+    ]
+    AI.user_sessions = session_store.Session_Store()
+    return results
+
+def bench_transcripts(turns: int, repeat: int, rng: random.Random) -> list[dict]:
+    "Operations whose cost grows with the length of one transcript."
+    scale = f"{turns} turns"
+    model, session_id = MODELS[0], str(uuid.uuid4())
+    path = AI._chat_path(model, session_id)
+    template = os.path.join(os.path.dirname(AI.ACTIVE_DIR), "templates", f"{turns}.txt")
+    write_transcript(template, model, turns, rng)
+    trailing = template + ".trailing"
+    write_transcript(trailing, model, turns, random.Random(turns), trailing_user=True)
+
+    def fresh(source=template):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(source, path)
+        archived = os.path.join(AI.ARCHIVE_DIR, model)
+        if os.path.isdir(archived): shutil.rmtree(archived)
+
+    fresh()
+    results = [
+        measure("AI._load_history", scale, lambda: AI._load_history(model, session_id), repeat),
+        measure("AI._append_chat", scale, lambda: AI._append_chat(model, session_id, _sentence(rng, 15), _sentence(rng, 60)), repeat, fresh),
+        measure("AI._archive_chat", scale, lambda: AI._archive_chat(model, session_id), repeat, fresh),
+        measure("AI.remove_trailing_user_if_no_ai", scale, lambda: AI.remove_trailing_user_if_no_ai(model, session_id), repeat, lambda: fresh(trailing)),
+        measure("support.get_last_message_pair", scale, lambda: support.get_last_message_pair(model, session_id), repeat, fresh),
+    ]
+    os.remove(path)
+    return results
+
+def compare(results: list[dict], baseline_path: str) -> None:
+    with open(baseline_path, "rb") as f:
+        baseline = {(r["op"], r["scale"]): r for r in orjson.loads(f.read())["results"]}
+    print(f"\nCompared to {os.path.basename(baseline_path)} (median time, peak memory):")
+    ratio = lambda new, before: f"{new / before:.2f}x" if before else "-"
+    for r in results:
+        old = baseline.get((r["op"], r["scale"]))
+        if not old: continue
+        if "bytes_per_session" in r:
+            print(f"{r['op']:<38}{r['scale']:<22}{'':>10}{ratio(r['bytes_per_session'], old['bytes_per_session']):>10}")
+            continue
+        print(f"{r['op']:<38}{r['scale']:<22}{ratio(r['median_ms'], old['median_ms']):>10}{ratio(r['peak_kb'], old['peak_kb']):>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description="NBD AI storage micro-benchmarks")
+    parser.add_argument("--users", type=int, nargs="+", default=[10_000, 100_000], help="user counts to test (default: 10000 100000)")
+    parser.add_argument("--sessions", type=int, nargs=2, default=[1, 50], metavar=("MIN", "MAX"),
+                        help="range of sessions per user, most users are near MIN (default: 1 50)")
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 100, 1000, 5000], help="transcript lengths to test (default: 10 100 1000 5000)")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per operation (default: 5)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", help="earlier results JSON to compare with")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    work_dir = tempfile.mkdtemp(prefix="nbd-bench-")
+    # Everything the benchmarked functions write goes to the temporary directory
+    AI.DATA_FILE = os.path.join(work_dir, "users_sessions.json")
+    AI.ACTIVE_DIR = os.path.join(work_dir, "active_chats")
+    AI.ARCHIVE_DIR = os.path.join(work_dir, "archived_chats")
+    search_index.INDEX_DIR = os.path.join(work_dir, "search_index")
+    memory.MEMORY_DIR = os.path.join(work_dir, "memory_index")
+    usage_store.use_dir(os.path.join(work_dir, "usage"))
+
+    print(f"{'operation':<38}{'scale':<22}{'median':>15}{'peak memory':>17}")
+    results = []
+    try:
+        for users in args.users:
+            results += bench_sessions(users, args.sessions, args.repeat, rng)
+        for turns in args.turns:
+            results += bench_transcripts(turns, args.repeat, rng)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    out_path = os.path.join(RESULTS_DIR, f"storage-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(out_path, "wb") as f:
+        f.write(orjson.dumps({"date": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+                              "platform": platform.platform(), "args": vars(args), "results": results}, option=orjson.OPT_INDENT_2))
+    print(f"\nResults saved to {out_path}")
+    if args.baseline: compare(results, args.baseline)
+
+if __name__ == "__main__":
+    main()
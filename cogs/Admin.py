@@ -0,0 +1,30 @@
+from discord.ext import commands
+from discord import Interaction, app_commands, Embed, Color, File
+from support import log
+import os, diagnostics
+
+class Admin(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+    @app_commands.allowed_contexts(guilds=True,dms=True,private_channels=True)
+    @app_commands.command(name="profile", description="(Owner only) Profile the bot's event loop")
+    @app_commands.describe(seconds="How long to sample for (1-120)")
+    async def profile(self, interaction: Interaction, seconds: app_commands.Range[int, 1, 120] = 15):
+        if not await self.bot.is_owner(interaction.user):
+            await interaction.response.send_message(embed=Embed(description="This command is only for the bot owner.",color=Color.red()),ephemeral=True)
+            return
+
+        await interaction.response.defer(ephemeral=True)
+        await log(f"[INFO] {interaction.user.name} started a {seconds}s profile")
+        path, samples = await diagnostics.profile_loop(seconds)
+
+        watchdog = diagnostics.watchdog
+        await interaction.followup.send(embed=Embed(title="Event loop profile",description=f"Samples: **{samples}**\n" \
+                    f"Loop stalls over {watchdog.threshold}s since start: **{watchdog.stalls}**\nMax loop lag: **{watchdog.max_lag:.3f}s**\n\n" \
+                    "-# Collapsed stacks file, open with speedscope or flamegraph.pl",color=Color.blue()),
+                    file=File(path, filename=os.path.basename(path)),ephemeral=True)
+        await log(f"[INFO] Profile saved to {path}")
+
+async def setup(bot: commands.Bot):
+    await bot.add_cog(Admin(bot))
@@ -1,6 +1,7 @@
 from discord.ext import commands
-from discord import Interaction, app_commands
-from support import get_user_sessions, Sessions_View, split_sessions_into_pages, log
+from discord import Interaction, app_commands, Embed, Color
+from support import get_user_sessions, Sessions_View, Search_Results_View, Group_Respond_View, split_sessions_into_pages, group_embeds, add_session_to_db, models_file, log, generation_failed, SEARCH_QUERY_MAX
+import asyncio, search_index, AI, orjson, tracing, ollama_supervisor
 
 class Chat(commands.Cog):
     def __init__(self, bot):
@@ -8,6 +9,7 @@ class Chat(commands.Cog):
 
     @app_commands.allowed_contexts(guilds=True,dms=True,private_channels=True)
     @app_commands.command(name="start", description="Start command")
+    @tracing.traced_interaction
     async def start(self, interaction: Interaction):
         await interaction.response.defer(ephemeral=True)
 
@@ -23,7 +25,52 @@ class Chat(commands.Cog):
         view = Sessions_View(pages, no_sessions, 0, interaction.user.display_name)
         await interaction.followup.send(embed=view.create_embed(), view=view)
         await log(f"[ACTION] Displayed user sessions to {interaction.user.name} (start command)")
-            
+
+    @app_commands.allowed_contexts(guilds=True,dms=True,private_channels=True)
+    @app_commands.command(name="search", description="Search your sessions by keywords")
+    @app_commands.describe(keywords="Words that appear in the session (all of them must match)")
+    @tracing.traced_interaction
+    async def search(self, interaction: Interaction, keywords: app_commands.Range[str, 1, SEARCH_QUERY_MAX]):
+        await interaction.response.defer(ephemeral=True)
+
+        results = await asyncio.to_thread(search_index.search, interaction.user.id, keywords)
+        view = Search_Results_View(keywords, results)
+        if results:
+            await interaction.followup.send(embed=view.create_embed(), view=view)
+        else:
+            await interaction.followup.send(embed=view.create_embed())
+        await log(f"[ACTION] {interaction.user.name} searched sessions ({len(results)} results)")
+
+    @app_commands.allowed_contexts(guilds=True,dms=True,private_channels=True)
+    @app_commands.command(name="group", description="Start a scene with several characters")
+    @app_commands.describe(characters=f"2 to {AI.GROUP_MAX_MEMBERS} character names, separated by commas", name="Session name")
+    @tracing.traced_interaction
+    async def group(self, interaction: Interaction, characters: str, name: str = None):
+        await interaction.response.defer(ephemeral=True)
+
+        with tracing.span("models.json"), open(models_file, "rb") as f:
+            available = list(orjson.loads(f.read()).keys())
+        members = []
+        for requested in characters.split(","):
+            model = next((item for item in available if item.lower() == requested.strip().lower()), None)
+            if not model:
+                await interaction.followup.send(embed=Embed(description=f"Model `{requested.strip()}` does not exist.", color=Color.red()),ephemeral=True)
+                return
+            if model not in members: members.append(model)
+        if not 2 <= len(members) <= AI.GROUP_MAX_MEMBERS:
+            await interaction.followup.send(embed=Embed(description=f"Group scene needs 2 to {AI.GROUP_MAX_MEMBERS} different characters.", color=Color.red()),ephemeral=True)
+            return
+
+        msg = await interaction.followup.send(embed=Embed(description="Generating...",color=Color.gold()),ephemeral=True)
+        meta = {}
+        try: session_id, replies = await AI.start_group_session(interaction.user.id, members, name, meta=meta)
+        except ollama_supervisor.Ollama_Unavailable as e:
+            await generation_failed(interaction, msg.edit, e)
+            return
+        await add_session_to_db(interaction, session_id)
+        await msg.edit(embeds=await group_embeds(replies, meta=meta), view=Group_Respond_View(session_id))
+        await log(f"[ACTION] {interaction.user.name} started group session ({session_id}) with {', '.join(members)}")
+
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(Chat(bot))
\ No newline at end of file
@@ -0,0 +1,99 @@
+import os, sys, time, threading, asyncio, traceback
+from collections import Counter
+from datetime import datetime
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROFILES_DIR = os.path.join(BASE_DIR, "profiles")
+LOGS_FILE = os.path.join(BASE_DIR, "logs.txt")
+
+LAG_THRESHOLD = 0.25    # seconds the event loop may be blocked before its stack is logged
+HEARTBEAT = 0.05        # seconds between event loop heartbeats
+SAMPLE_INTERVAL = 0.005 # seconds between profiler samples
+
+def _log(message: str) -> None:
+    "Same format as support.log, but callable from any thread."
+    with open(LOGS_FILE, "a", encoding="utf-8") as f:
+        f.write(str(datetime.now().replace(microsecond=0)) + f" --> {message}\n")
+
+class Loop_Watchdog:
+    """
+    Measures event loop lag. A heartbeat coroutine ticks every HEARTBEAT seconds; a separate thread checks the ticks
+    and, when the loop hasn't ticked for LAG_THRESHOLD, logs the stack the loop thread is stuck in.
+    """
+    def __init__(self, threshold: float = LAG_THRESHOLD, interval: float = HEARTBEAT):
+        self.threshold = threshold
+        self.interval = interval
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._beat = time.monotonic()
+        self._loop_thread = None
+        self._task = None
+
+    def start(self) -> None:
+        "Must be called from the running event loop."
+        if self._task: return
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    async def _heartbeat(self) -> None:
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self._beat = time.monotonic()
+            self.max_lag = max(self.max_lag, self._beat - before - self.interval)
+
+    def _watch(self) -> None:
+        stalled_since = None
+        while not self._task.done():
+            time.sleep(self.interval)
+            beat = self._beat
+            blocked = time.monotonic() - beat
+            if blocked >= self.threshold and stalled_since != beat:
+                stalled_since = beat
+                self.stalls += 1
+                frame = sys._current_frames().get(self._loop_thread)
+                stack = "".join(traceback.format_stack(frame)) if frame else "(stack unavailable)\n"
+                _log(f"[LAG] Event loop blocked for over {blocked:.2f}s, in:\n{stack.rstrip()}")
+            elif stalled_since is not None and stalled_since != beat:
+                _log(f"[LAG] Event loop unblocked after {beat - stalled_since:.2f}s")
+                stalled_since = None
+
+watchdog = Loop_Watchdog()
+
+# ---------------------------
+# SAMPLING PROFILER
+# ---------------------------
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+def sample(thread_id: int, seconds: float, interval: float = SAMPLE_INTERVAL) -> Counter:
+    "Samples the thread's stack for `seconds`. Returns {collapsed stack: samples}, outermost frame first."
+    stacks = Counter()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        frame = sys._current_frames().get(thread_id)
+        names = []
+        while frame is not None:
+            names.append(_frame_name(frame))
+            frame = frame.f_back
+        if names: stacks[";".join(reversed(names))] += 1
+        time.sleep(interval)
+    return stacks
+
+def write_collapsed(stacks: Counter, path: str) -> None:
+    "Writes stacks in collapsed format (`a;b;c count`), readable by flamegraph.pl, speedscope and inferno."
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+
+async def profile_loop(seconds: float) -> tuple[str, int]:
+    "Profiles the running event loop's thread for `seconds`. Returns (collapsed stacks file, sample count)."
+    thread_id = threading.get_ident()
+    stacks = await asyncio.to_thread(sample, thread_id, seconds)
+    path = os.path.join(PROFILES_DIR, f"loop-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded")
+    await asyncio.to_thread(write_collapsed, stacks, path)
+    return path, sum(stacks.values())
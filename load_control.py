@@ -0,0 +1,109 @@
+import asyncio, time
+from contextlib import asynccontextmanager
+
+# Degradation levels
+NORMAL = 0
+REDUCED = 1     # shorter replies and smaller context
+LIGHT = 2       # REDUCED + lighter variant of the character's model
+
+LIGHT_SUFFIX = "-light"
+
+DEFAULT_CONFIG = {
+    "max_concurrent": "auto",       # generations sent to Ollama at once, the rest wait in queue ("auto" = parallel slots of all instances)
+    "reduced_num_predict": 200,     # reply length limit (tokens) when degraded
+    "reduced_num_ctx": 4096,        # context size when degraded, below the characters' num_ctx (8192 in models_data.json)
+    "reduce_queue": 4,              # queued requests needed to enter REDUCED
+    "light_queue": 10,              # queued requests needed to enter LIGHT
+    "reduce_tokens_per_s": 0,       # generation speed below which REDUCED is entered (0 = off)
+    "light_tokens_per_s": 0,        # generation speed below which LIGHT is entered (0 = off)
+    "recover_ratio": 0.5,           # load must drop below threshold * ratio to step down
+    "cooldown": 60                  # seconds a lower level must hold before stepping down
+}
+
+class Load_Controller:
+    """
+    Tracks queue depth and recent generation speed, and picks how much each request may generate.
+    Steps up as soon as load crosses a threshold, steps down only after load stays below
+    threshold * recover_ratio for `cooldown` seconds, so it doesn't flap around a threshold.
+    """
+    def __init__(self, config: dict | None = None):
+        self.capacity = 2           # parallel slots of the Ollama instances, set by set_capacity once they're planned
+        self.configure(config or {})
+        self.waiting = 0
+        self.running = 0
+        self.tokens_per_s = None
+        self.level = NORMAL
+        self._calm_since = None
+        self.light_models: set[str] = set()
+
+    def configure(self, config: dict) -> None:
+        "Applies the `load` section of models_data.json."
+        self.config = {**DEFAULT_CONFIG, **config}
+        limit = self.config["max_concurrent"]
+        limit = max(self.capacity if limit == "auto" else int(limit), 1)
+        # init_sessions runs often, keep the semaphore (and whoever waits on it) unless the limit changed
+        if getattr(self, "_limit", None) != limit:
+            self._limit = limit
+            self._semaphore = asyncio.Semaphore(limit)
+
+    def set_capacity(self, slots: int) -> None:
+        "Sets how many generations the Ollama instances run at once, the limit when max_concurrent is auto."
+        self.capacity = max(int(slots), 1)
+        self.configure(self.config)
+
+    @asynccontextmanager
+    async def slot(self):
+        "Waits for a free generation slot. Time spent here is queue time."
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self._semaphore.release()
+
+    def record(self, eval_count: int | None, eval_duration: int | None) -> None:
+        "Feeds the speed reported in Ollama's final chunk (duration is in nanoseconds) into a moving average."
+        if not eval_count or not eval_duration: return
+        speed = eval_count / (eval_duration / 1e9)
+        self.tokens_per_s = speed if self.tokens_per_s is None else self.tokens_per_s * 0.8 + speed * 0.2
+
+    def _target(self, ratio: float = 1.0) -> int:
+        cfg = self.config
+        slow = lambda limit: limit and self.tokens_per_s is not None and self.tokens_per_s < limit / ratio
+        if self.waiting >= cfg["light_queue"] * ratio or slow(cfg["light_tokens_per_s"]): return LIGHT
+        if self.waiting >= cfg["reduce_queue"] * ratio or slow(cfg["reduce_tokens_per_s"]): return REDUCED
+        return NORMAL
+
+    def update(self) -> int:
+        "Re-evaluates and returns the current level."
+        target = self._target()
+        if target > self.level:
+            self.level = target
+            self._calm_since = None
+        elif self.level > NORMAL and self._target(self.config["recover_ratio"]) < self.level:
+            now = time.monotonic()
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= self.config["cooldown"]:
+                self.level -= 1
+                self._calm_since = None
+        else:
+            self._calm_since = None
+        return self.level
+
+    def plan(self, model: str) -> tuple[str, dict, int]:
+        "Returns (model to use, options for /api/chat, level)."
+        level = self.update()
+        if level == NORMAL:
+            return model, {}, level
+        options = {"num_predict": self.config["reduced_num_predict"], "num_ctx": self.config["reduced_num_ctx"]}
+        if level == LIGHT and model + LIGHT_SUFFIX in self.light_models:
+            model += LIGHT_SUFFIX
+        return model, options, level
+
+controller = Load_Controller()
@@ -1,4 +1,4 @@
-import asyncio, json, logging, support, subprocess, sys
+import asyncio, json, logging, support, subprocess, sys, diagnostics, AI, ollama_supervisor
 from discord.ext import commands
 
 try: import discord
@@ -24,13 +24,23 @@ async def on_ready():
 async def load_cogs():
     await bot.load_extension("cogs.Chat")
     await bot.load_extension("cogs.Misc")
+    await bot.load_extension("cogs.Admin")
 
 async def main():
-    subprocess.Popen(["ollama", "serve"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     async with bot:
+        diagnostics.watchdog.start()
+        await AI.start_ollama()
+        # Sessions must be loaded before buttons of messages sent before restart are clicked
+        AI.init_sessions()
+        support.register_persistent_items(bot)
         await load_cogs()
-        with open(support.startup_file,"r") as f:
-            data = json.load(f)
-            await bot.start(data["token"])
+        try:
+            with open(support.startup_file,"r") as f:
+                data = json.load(f)
+                await bot.start(data["token"])
+        finally:
+            # Session changes are written behind, anything pending is saved before exiting
+            await AI.flush_sessions()
+            await ollama_supervisor.supervisor.stop()
 
 asyncio.run(main())
\ No newline at end of file
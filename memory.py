@@ -0,0 +1,181 @@
+import os, asyncio, aiohttp, orjson, struct, subprocess, sys, ollama_supervisor, tracing
+
+try: import numpy as np
+except ImportError:
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "numpy"])
+    import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MEMORY_DIR = os.path.join(BASE_DIR, "memory_index")
+
+EMBED_MODEL = "nomic-embed-text"
+
+RECENT_TURNS = 6        # turns always sent verbatim
+TOP_K = 4               # older turns recalled per reply
+MIN_SCORE = 0.25        # cosine similarity needed to recall a turn
+EMBED_BATCH = 32        # turns embedded per request when catching up
+
+HEADER = struct.Struct("<I")  # vector dimension, stored at the start of every .vec file
+
+_locks: dict[str, asyncio.Lock] = {}
+_tasks: set[asyncio.Task] = set()
+
+# ---------------------------
+# DISK HELPERS
+# ---------------------------
+def _vec_path(model, session_id):
+    return os.path.join(MEMORY_DIR, model, f"{session_id}.vec")
+
+def _open_vectors(model, session_id):
+    """Memory-maps the session's vectors. Row i is the embedding of turn i. Returns None if nothing is indexed."""
+    path = _vec_path(model, session_id)
+    if not os.path.exists(path): return None
+    size = os.path.getsize(path)
+    if size <= HEADER.size: return None
+    with open(path, "rb") as f:
+        dim, = HEADER.unpack(f.read(HEADER.size))
+    rows = (size - HEADER.size) // (dim * 4)
+    if not rows: return None
+    return np.memmap(path, dtype="<f4", mode="r", offset=HEADER.size, shape=(rows, dim))
+
+def _indexed_turns(model, session_id):
+    vecs = _open_vectors(model, session_id)
+    return 0 if vecs is None else vecs.shape[0]
+
+def _append_vectors(model, session_id, vectors):
+    path = _vec_path(model, session_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    vectors = np.asarray(vectors, dtype="<f4")
+    # Normalised once on write, so cosine similarity is a plain dot product on read
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms == 0, 1, norms)
+    new = not os.path.exists(path) or os.path.getsize(path) < HEADER.size
+    with open(path, "ab") as f:
+        if new: f.write(HEADER.pack(vectors.shape[1]))
+        f.write(vectors.tobytes())
+
+def _truncate(model, session_id, turns):
+    "Drops vectors of turn `turns` and later (used when a transcript is rewritten)."
+    path = _vec_path(model, session_id)
+    if not os.path.exists(path): return
+    with open(path, "rb+") as f:
+        dim, = HEADER.unpack(f.read(HEADER.size))
+        f.truncate(HEADER.size + max(turns, 0) * dim * 4)
+
+def _copy(model, session_id, new_session_id, turns):
+    "Copies vectors of the first `turns` turns to another session (used for branches)."
+    path = _vec_path(model, session_id)
+    if not os.path.exists(path): return
+    with open(path, "rb") as f:
+        dim, = HEADER.unpack(f.read(HEADER.size))
+        data = f.read(turns * dim * 4)
+    new_path = _vec_path(model, new_session_id)
+    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+    with open(new_path, "wb") as f:
+        f.write(HEADER.pack(dim) + data)
+
+def _drop(model, session_id):
+    path = _vec_path(model, session_id)
+    if os.path.exists(path): os.remove(path)
+
+def _top_turns(model, session_id, query, limit):
+    "Returns indexes of the most similar turns below `limit`, in chronological order."
+    vecs = _open_vectors(model, session_id)
+    if vecs is None: return []
+    vecs = vecs[:limit]
+    if not len(vecs): return []
+    query = np.asarray(query, dtype="<f4")
+    if query.shape[0] != vecs.shape[1]: return []
+    query /= np.linalg.norm(query) or 1
+    scores = vecs @ query
+    k = min(TOP_K, len(scores))
+    best = np.argpartition(scores, -k)[-k:]
+    best = best[scores[best] >= MIN_SCORE]
+    return sorted(best.tolist())
+
+# ---------------------------
+# EMBEDDINGS
+# ---------------------------
+def _turn_text(history, turn):
+    user, ai = history[turn*2], history[turn*2+1]
+    return f"User: {user['content']}\n{ai['content']}"
+
+async def embed(texts: list[str]) -> list[list[float]] | None:
+    "Embeds the texts through the local Ollama server. Returns None if it's unreachable or the model isn't pulled."
+    async with ollama_supervisor.supervisor.endpoint() as (base_url, _), aiohttp.ClientSession() as client:
+        try:
+            async with client.post(f"{base_url}/api/embed", json={"model": EMBED_MODEL, "input": texts}) as resp:
+                if resp.status != 200: return None
+                data = orjson.loads(await resp.read())
+        except Exception:
+            return None
+    vectors = data.get("embeddings")
+    return vectors if vectors and len(vectors) == len(texts) else None
+
+# ---------------------------
+# INDEXING
+# ---------------------------
+def _lock(model, session_id) -> asyncio.Lock:
+    "Held by everything that changes the session's index, so a sync doesn't append to a file being cut or copied."
+    return _locks.setdefault(f"{model}/{session_id}", asyncio.Lock())
+
+async def sync_index(model, session_id, history):
+    "Embeds every completed turn of `history` that isn't indexed yet."
+    async with _lock(model, session_id):
+        done = await asyncio.to_thread(_indexed_turns, model, session_id)
+        total = len(history) // 2
+        while done < total:
+            batch = [_turn_text(history, t) for t in range(done, min(done + EMBED_BATCH, total))]
+            vectors = await embed(batch)
+            if vectors is None: return
+            await asyncio.to_thread(_append_vectors, model, session_id, vectors)
+            done += len(batch)
+
+def remember(model, session_id, history):
+    "Schedules `sync_index` in the background so the reply isn't held up by embedding."
+    task = asyncio.create_task(sync_index(model, session_id, list(history)))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+async def truncate(model, session_id, turns):
+    async with _lock(model, session_id):
+        await asyncio.to_thread(_truncate, model, session_id, turns)
+
+async def copy(model, session_id, new_session_id, turns):
+    async with _lock(model, session_id), _lock(model, new_session_id):
+        await asyncio.to_thread(_copy, model, session_id, new_session_id, turns)
+
+async def drop(model, session_id):
+    async with _lock(model, session_id):
+        await asyncio.to_thread(_drop, model, session_id)
+    _locks.pop(f"{model}/{session_id}", None)
+
+# ---------------------------
+# RETRIEVAL
+# ---------------------------
+@tracing.traced()
+async def build_context(model, session_id, history, user_msg):
+    """
+    Returns the messages to send instead of the whole history: the last RECENT_TURNS turns verbatim, with relevant
+    older turns recalled from the index ahead of the first of them.
+    Falls back to the whole history while older turns aren't indexed yet or embeddings are unavailable.
+    """
+    recent_start = max(len(history) - RECENT_TURNS*2, 0)
+    recent_start -= recent_start % 2
+    if recent_start == 0:
+        return list(history)
+    if await asyncio.to_thread(_indexed_turns, model, session_id) < recent_start // 2:
+        return list(history)
+
+    query = await embed([f"{history[-1]['content']}\nUser: {user_msg}"])
+    if query is None:
+        return list(history)
+
+    turns = await asyncio.to_thread(_top_turns, model, session_id, query[0], recent_start // 2)
+    context = list(history[recent_start:])
+    if turns:
+        recalled = "\n\n".join(_turn_text(history, t) for t in turns)
+        # In the first recent user message, so the turns keep alternating and the request doesn't start with a
+        # system message (Ollama then leaves out the Modelfile's SYSTEM prompt, the character)
+        context[0] = {"role": "user", "content": f"(Earlier events of this roleplay, for continuity:\n\n{recalled})\n\n{context[0]['content']}"}
+    return context
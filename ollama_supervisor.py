@@ -0,0 +1,195 @@
+import os, asyncio, aiohttp, subprocess, time
+from contextlib import asynccontextmanager
+from diagnostics import _log
+
+DEFAULT_CONFIG = {
+    "instances": 1,         # Ollama servers to run, or "auto" to split big machines into CORES_PER_INSTANCE chunks
+    "base_port": 11434,     # first instance's port, next ones count up from it
+    "model_ram_gb": 6,      # RAM one loaded model takes (llama3.1:8b Q4 + context)
+    "num_parallel": None,   # OLLAMA_NUM_PARALLEL override, detected if None
+    "max_loaded_models": None  # OLLAMA_MAX_LOADED_MODELS override, detected if None
+}
+
+CORES_PER_INSTANCE = 16     # used by "instances": "auto"
+HEALTH_INTERVAL = 5         # seconds between health checks
+HEALTH_FAILURES = 3         # failed checks in a row before a running server is restarted
+MAX_BACKOFF = 60            # seconds, restart delay doubles up to this
+STABLE_AFTER = 120          # seconds of uptime that reset the backoff
+START_TIMEOUT = 30          # seconds start() waits for spawned servers to answer
+
+class Ollama_Unavailable(Exception):
+    "No Ollama instance could generate a reply."
+
+def detect_hardware() -> tuple[list[int], float]:
+    "Returns (usable CPU cores, total RAM in GB)."
+    try: cores = sorted(os.sched_getaffinity(0))
+    except AttributeError: cores = list(range(os.cpu_count() or 1))
+    try: ram = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3
+    except (AttributeError, ValueError, OSError): ram = 16.0
+    return cores, ram
+
+class Ollama_Instance:
+    def __init__(self, port: int, cores: list[int] | None, env: dict[str, str], threads: int | None):
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.cores = cores
+        self.env = env
+        self.threads = threads
+        self.process: subprocess.Popen | None = None
+        self.external = False       # server was already running, only health checked
+        self.healthy = False
+        self.failures = 0
+        self.restarts = 0
+        self.started = 0.0
+        self.restart_at = 0.0
+        self.busy = 0
+
+class Ollama_Supervisor:
+    """
+    Owns the `ollama serve` processes: tunes them to the machine, health checks them and restarts them
+    with exponential backoff when they die or stop responding. Generation picks the least busy healthy instance.
+    """
+    def __init__(self):
+        self.instances: list[Ollama_Instance] = []
+        self._task: asyncio.Task | None = None
+
+    def plan(self, config: dict, character_count: int) -> list[Ollama_Instance]:
+        "Works out instance count, core sets and Ollama settings from the hardware and config."
+        cfg = {**DEFAULT_CONFIG, **config}
+        cores, ram = detect_hardware()
+        count = cfg["instances"]
+        if count == "auto":
+            count = max(len(cores) // CORES_PER_INSTANCE, 1)
+        count = max(min(int(count), len(cores)), 1)
+
+        per_instance = len(cores) // count
+        ram_per_instance = ram / count
+        instances = []
+        for i in range(count):
+            core_set = cores[i*per_instance:(i+1)*per_instance] if count > 1 else None
+            fits = max(int(ram_per_instance // cfg["model_ram_gb"]), 1)
+            max_loaded = cfg["max_loaded_models"] or min(fits, max(character_count, 1))
+            # Each parallel slot takes its own context memory and shares the cores, more than 4 rarely helps on CPU
+            parallel = cfg["num_parallel"] or max(min(per_instance // 4, fits * 2, 4), 1)
+            env = {
+                "OLLAMA_HOST": f"127.0.0.1:{cfg['base_port'] + i}",
+                "OLLAMA_NUM_PARALLEL": str(parallel),
+                "OLLAMA_MAX_LOADED_MODELS": str(max_loaded)
+            }
+            # Single instance is left to pick its own thread count, pinned ones use exactly their cores
+            threads = per_instance if count > 1 else None
+            instances.append(Ollama_Instance(cfg["base_port"] + i, core_set, env, threads))
+        return instances
+
+    async def start(self, config: dict | None = None, character_count: int = 1) -> None:
+        if self._task: return
+        self.instances = self.plan(config or {}, character_count)
+        for inst in self.instances:
+            if await self._check(inst):
+                inst.external = inst.healthy = True
+                _log(f"[INFO] Ollama already running on port {inst.port}, not starting another one")
+            else:
+                self._spawn(inst)
+        # Models are created right after this, so wait until the spawned servers listen
+        deadline = time.monotonic() + START_TIMEOUT
+        waiting = [i for i in self.instances if not i.healthy and i.process]
+        while waiting and time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+            waiting = [i for i in waiting if i.process.poll() is None and not await self._check(i)]
+        for inst in waiting:
+            _log(f"[ERROR] Ollama on port {inst.port} didn't answer within {START_TIMEOUT}s of starting")
+        self._task = asyncio.create_task(self._monitor())
+
+    def capacity(self) -> int:
+        "Generations all instances run at once (sum of their OLLAMA_NUM_PARALLEL)."
+        return sum(int(i.env["OLLAMA_NUM_PARALLEL"]) for i in self.instances) or 1
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for inst in self.instances:
+            if inst.process and inst.process.poll() is None:
+                inst.process.terminate()
+                try: await asyncio.to_thread(inst.process.wait, 10)
+                except subprocess.TimeoutExpired: inst.process.kill()
+
+    def _spawn(self, inst: Ollama_Instance) -> None:
+        pin = None
+        if inst.cores and hasattr(os, "sched_setaffinity"):
+            pin = lambda: os.sched_setaffinity(0, inst.cores)
+        try:
+            inst.process = subprocess.Popen(["ollama", "serve"], env={**os.environ, **inst.env}, preexec_fn=pin,
+                                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            inst.process = None
+            _log(f"[ERROR] Couldn't start Ollama on port {inst.port}: {e}")
+        inst.started = time.monotonic()
+        inst.failures = 0
+
+    async def _check(self, inst: Ollama_Instance) -> bool:
+        try:
+            async with aiohttp.ClientSession() as client:
+                async with client.get(f"{inst.url}/api/version", timeout=aiohttp.ClientTimeout(total=3)) as resp:
+                    inst.healthy = resp.status == 200
+        except Exception:
+            inst.healthy = False
+        return inst.healthy
+
+    def _schedule_restart(self, inst: Ollama_Instance, reason: str) -> None:
+        if time.monotonic() - inst.started > STABLE_AFTER: inst.restarts = 0
+        delay = min(2 ** inst.restarts, MAX_BACKOFF)
+        inst.restarts += 1
+        inst.restart_at = time.monotonic() + delay
+        inst.healthy = False
+        _log(f"[ERROR] Ollama on port {inst.port} {reason}, restarting in {delay}s")
+
+    async def _monitor(self) -> None:
+        while True:
+            for inst in self.instances:
+                if inst.restart_at:
+                    if time.monotonic() >= inst.restart_at:
+                        inst.restart_at = 0
+                        self._spawn(inst)
+                    continue
+                if inst.external:
+                    # Take over if the server that was already running goes away
+                    inst.failures = 0 if await self._check(inst) else inst.failures + 1
+                    if inst.failures >= HEALTH_FAILURES:
+                        inst.external = False
+                        self._schedule_restart(inst, "(not started by the bot) stopped responding")
+                    continue
+                if inst.process is None or inst.process.poll() is not None:
+                    code = None if inst.process is None else inst.process.returncode
+                    self._schedule_restart(inst, f"exited (code {code})")
+                elif await self._check(inst):
+                    inst.failures = 0
+                elif time.monotonic() - inst.started > HEALTH_INTERVAL * 2:
+                    inst.failures += 1
+                    if inst.failures >= HEALTH_FAILURES:
+                        inst.process.kill()
+                        self._schedule_restart(inst, "stopped responding")
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    def report_failure(self, url: str) -> None:
+        "Called when a request to `url` failed, so it's skipped until the next successful health check."
+        for inst in self.instances:
+            if inst.url == url: inst.healthy = False
+
+    @asynccontextmanager
+    async def endpoint(self, exclude: set[str] = frozenset()):
+        "Yields (base URL, extra /api/chat options) of the least busy healthy instance whose URL isn't in `exclude`."
+        candidates = [i for i in self.instances if i.url not in exclude]
+        healthy = [i for i in candidates if i.healthy] or candidates
+        if not healthy:
+            # Not started (e.g. Ollama managed outside the bot), use the default server
+            yield f"http://127.0.0.1:{DEFAULT_CONFIG['base_port']}", {}
+            return
+        inst = min(healthy, key=lambda i: i.busy)
+        inst.busy += 1
+        try:
+            yield inst.url, ({"num_thread": inst.threads} if inst.threads else {})
+        finally:
+            inst.busy -= 1
+
+supervisor = Ollama_Supervisor()
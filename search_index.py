@@ -0,0 +1,193 @@
+import os, re, threading, orjson
+from collections import OrderedDict
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+INDEX_DIR = os.path.join(BASE_DIR, "search_index")
+SESSIONS_DB_FILE = os.path.join(BASE_DIR, "sessions_db.json")
+
+MAX_CACHED_USERS = 256
+MAX_RESULTS = 25
+
+WORD = re.compile(r"\w{2,}")
+STOPWORDS = frozenset("""
+a an and are as at be but by for from he her him his i if in into is it its me my no not of on or our she so
+that the their them then there they this to was we were what when which who will with you your
+""".split())
+
+def tokenize(text: str) -> set[str]:
+    return {w for w in WORD.findall(text.lower()) if w not in STOPWORDS}
+
+class User_Index:
+    """
+    Inverted index of one user's sessions: term -> set of session slots.
+    Backed by an append-only log (one JSON line per change), where a turn of a loaded index only logs terms new
+    to its session, so the log grows with vocabulary, not with chat length. Session names are indexed apart from
+    the chat text, so a rename drops the old name's terms.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.terms: dict[str, set[int]] = {}
+        self.name_terms: dict[str, set[int]] = {}
+        self.sessions: list[list] = []          # slot -> [model, session_id, name, archived, order]
+        self.slots: dict[tuple[str, str], int] = {}
+        self.order = 0
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                for line in f:
+                    if line.strip(): self._apply(orjson.loads(line))
+
+    def _slot(self, model, session_id) -> int:
+        key = (model, session_id)
+        if key not in self.slots:
+            self.slots[key] = len(self.sessions)
+            self.sessions.append([model, session_id, None, False, 0])
+        return self.slots[key]
+
+    def _apply(self, entry) -> None:
+        kind, model, session_id, value = entry
+        slot = self._slot(model, session_id)
+        self.order += 1
+        self.sessions[slot][4] = self.order
+        if kind == "terms":
+            for term in value: self.terms.setdefault(term, set()).add(slot)
+        elif kind == "name":
+            for term in tokenize(self.sessions[slot][2] or ""): self.name_terms[term].discard(slot)
+            for term in tokenize(value or ""): self.name_terms.setdefault(term, set()).add(slot)
+            self.sessions[slot][2] = value
+        elif kind == "archived":
+            self.sessions[slot][3] = True
+
+    def _log(self, entry) -> None:
+        self._apply(entry)
+        _append_log(self.path, entry)
+
+    def add_text(self, model, session_id, text) -> None:
+        slot = self._slot(model, session_id)
+        new = [t for t in tokenize(text) if slot not in self.terms.get(t, ())]
+        if new:
+            self._log(["terms", model, session_id, new])
+        else:
+            self.order += 1
+            self.sessions[slot][4] = self.order
+
+    def search(self, query: str) -> list[dict]:
+        "Sessions containing every keyword, active ones first, most recently updated first."
+        words = tokenize(query)
+        if not words: return []
+        postings = sorted((self.terms.get(w, set()) | self.name_terms.get(w, set()) for w in words), key=len)
+        slots = set.intersection(*postings) if postings[0] else set()
+        found = [self.sessions[s] for s in slots]
+        found.sort(key=lambda s: (s[3], -s[4]))
+        return [{"model": m, "session_id": sid, "name": name, "archived": archived} for m, sid, name, archived, _ in found[:MAX_RESULTS]]
+
+def _append_log(path: str, entry) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "ab") as f:
+        f.write(orjson.dumps(entry) + b"\n")
+
+_cache: OrderedDict[str, User_Index] = OrderedDict()
+_cache_lock = threading.Lock()                      # held only to look up or insert, never while reading a log
+_user_locks: dict[str, threading.Lock] = {}         # one per user, held while their index or log is used
+
+def _user_lock(user_id) -> threading.Lock:
+    with _cache_lock:
+        return _user_locks.setdefault(str(user_id), threading.Lock())
+
+def _log_path(user_id) -> str:
+    return os.path.join(INDEX_DIR, f"{user_id}.log")
+
+def _cached(user_id) -> User_Index | None:
+    with _cache_lock:
+        index = _cache.get(str(user_id))
+        if index is not None: _cache.move_to_end(str(user_id))
+        return index
+
+def _user_index(user_id) -> User_Index:
+    "Returns the user's index, loading only that user's log. Caller must hold the user's lock."
+    index = _cached(user_id)
+    if index is None:
+        index = User_Index(_log_path(user_id))
+        with _cache_lock:
+            _cache[str(user_id)] = index
+            if len(_cache) > MAX_CACHED_USERS: _cache.popitem(last=False)
+    return index
+
+def _log(user_id, entry) -> None:
+    "Logs a change of the user's index. An index that isn't loaded reads it from the log when it's next searched."
+    index = _cached(user_id)
+    if index is not None: index._log(entry)
+    else: _append_log(_log_path(user_id), entry)
+
+# ---------------------------
+# UPDATES (called from AI disk helpers, in worker threads)
+# ---------------------------
+def add_turn(user_id, model, session_id, user_msg, ai_msg) -> None:
+    text = f"{user_msg}\n{ai_msg}"
+    with _user_lock(user_id):
+        index = _cached(user_id)
+        if index is not None: index.add_text(model, session_id, text)
+        # No log replay on the reply path, the terms may repeat ones already logged
+        elif terms := tokenize(text): _append_log(_log_path(user_id), ["terms", model, session_id, list(terms)])
+
+def set_name(user_id, model, session_id, name) -> None:
+    with _user_lock(user_id):
+        _log(user_id, ["name", model, session_id, name])
+
+def mark_archived(user_id, model, session_id) -> None:
+    with _user_lock(user_id):
+        _log(user_id, ["archived", model, session_id, True])
+
+# ---------------------------
+# QUERIES
+# ---------------------------
+def search(user_id, query: str) -> list[dict]:
+    """
+    Returns user's sessions matching all keywords of the query:
+    [{"model": str, "session_id": str, "name": str | None, "archived": bool}, ...]
+    """
+    with _user_lock(user_id):
+        return _user_index(user_id).search(query)
+
+# ---------------------------
+# REBUILD
+# ---------------------------
+def rebuild(active_dir: str, archive_dir: str, data_file: str) -> None:
+    """
+    One-off rebuild from existing transcripts. Active sessions are mapped to users with users_sessions.json,
+    archived ones with sessions_db.json. Turns written before the index existed aren't searchable until this runs.
+    """
+    owners, names = {}, {}
+    if os.path.exists(SESSIONS_DB_FILE):
+        for user_id, entries in orjson.loads(open(SESSIONS_DB_FILE, "rb").read()).items():
+            for session_id in entries[1:]: owners[session_id] = user_id
+    if os.path.exists(data_file):
+        for user_id, models in orjson.loads(open(data_file, "rb").read()).items():
+            for sessions in models.values():
+                for session_id, data in sessions.items():
+                    owners[session_id] = user_id
+                    names[session_id] = data[0]
+
+    with _cache_lock:
+        _cache.clear()
+        if os.path.isdir(INDEX_DIR):
+            for name in os.listdir(INDEX_DIR): os.remove(os.path.join(INDEX_DIR, name))
+
+    for archived, base in ((False, active_dir), (True, archive_dir)):
+        if not os.path.isdir(base): continue
+        for model in os.listdir(base):
+            for root, _, files in os.walk(os.path.join(base, model)):
+                for file in files:
+                    if not file.endswith(".txt"): continue
+                    # Archived copies may have a "_<timestamp>" suffix
+                    session_id = file[:-4].split("_")[0]
+                    user_id = owners.get(session_id)
+                    if user_id is None: continue
+                    if session_id in names: set_name(user_id, model, session_id, names[session_id])
+                    with open(os.path.join(root, file), "r", encoding="utf-8") as f:
+                        with _user_lock(user_id): _user_index(user_id).add_text(model, session_id, f.read())
+                    if archived: mark_archived(user_id, model, session_id)
+
+if __name__ == "__main__":
+    import AI
+    rebuild(AI.ACTIVE_DIR, AI.ARCHIVE_DIR, AI.DATA_FILE)
+    print("Search index rebuilt")
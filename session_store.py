@@ -0,0 +1,185 @@
+import sys, time, re, gc
+from bisect import bisect_left, insort
+from itertools import islice
+
+LEGACY_TS = re.compile(r"<t:(\d+):\w>")
+
+def _activity(record) -> tuple:
+    "Sort key of the activity index."
+    return record.last_active, record.session_id
+
+class Session_Record:
+    "One session. Timestamps are Unix epoch seconds, the Discord timestamp is only made when rendering."
+    __slots__ = ("user_id", "model", "session_id", "name", "last_active")
+
+    def __init__(self, user_id: str, model: str, session_id: str, name: str, last_active: float):
+        self.user_id = user_id
+        self.model = sys.intern(model)
+        self.session_id = session_id
+        self.name = name
+        self.last_active = last_active
+
+    def to_json(self) -> list:
+        "Form stored in users_sessions.json: [name, last modified (Unix epoch)]"
+        return [self.name, int(self.last_active)]
+
+class Session_Store:
+    """
+    All active sessions, as {user_id: {model: {session_id: Session_Record}}} in creation order (which also gives
+    the session numbers shown to users), plus indexes:
+    - by last activity: records sorted by (last_active, session_id), for recent / stale sessions
+    - per model: session count, for per-model stats
+    Changed sessions are collected in `changed` until taken with `take_changes`, so only they need saving.
+    """
+    def __init__(self):
+        self.users: dict[str, dict[str, dict[str, Session_Record]]] = {}
+        self.by_activity: list[Session_Record] = []
+        self.model_sessions: dict[str, int] = {}
+        self.changed: dict[str, tuple[Session_Record, bool]] = {}   # {session_id: (record, removed)}
+
+    def __len__(self) -> int:
+        return len(self.by_activity)
+
+    # ---------------------------
+    # LOAD / DUMP
+    # ---------------------------
+    @classmethod
+    def from_json(cls, data: dict) -> "Session_Store":
+        "Loads users_sessions.json. Old files stored '<t:...:R>' strings instead of numbers, both are accepted."
+        store = cls()
+        # Indexes are filled a (user, model) at a time and by_activity is sorted once, adding sessions one by one
+        # (each insort shifting the list) made loading quadratic. Collector is paused, it would rescan the growing
+        # store over and over while nothing here is garbage.
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            store._load(data)
+        finally:
+            if collecting: gc.enable()
+        store.by_activity = sorted((record for models in store.users.values() for records in models.values()
+                                    for record in records.values()), key=_activity)
+        return store
+
+    def _load(self, data: dict) -> None:
+        names = {}  # equal names ("New Session" and the like) share one string
+        for user_id, models in data.items():
+            user_id = str(user_id)
+            for model, sessions in models.items():
+                if not sessions: continue
+                model = sys.intern(model)
+                records = {}
+                for session_id, (name, last_active) in sessions.items():
+                    if isinstance(last_active, str):
+                        match = LEGACY_TS.fullmatch(last_active)
+                        last_active = int(match[1]) if match else 0
+                    records[session_id] = Session_Record(user_id, model, session_id, names.setdefault(name, name), last_active)
+                self.users.setdefault(user_id, {})[model] = records
+                self.model_sessions[model] = self.model_sessions.get(model, 0) + len(records)
+
+    def to_json(self) -> dict:
+        return {user_id: self.user_dict(user_id) for user_id in self.users}
+
+    def user_dict(self, user_id: str) -> dict[str, dict[str, list]]:
+        "User's sessions in users_sessions.json form: {model: {session_id: [name, last modified]}}"
+        return {model: {sid: record.to_json() for sid, record in sessions.items()}
+                for model, sessions in self.users.get(str(user_id), {}).items()}
+
+    # ---------------------------
+    # CHANGES
+    # ---------------------------
+    def add(self, user_id, model, session_id, name, last_active=None) -> Session_Record:
+        user_id = str(user_id)
+        record = Session_Record(user_id, model, session_id, name, time.time() if last_active is None else last_active)
+        self.users.setdefault(user_id, {}).setdefault(record.model, {})[session_id] = record
+        insort(self.by_activity, record, key=_activity)
+        self.model_sessions[record.model] = self.model_sessions.get(record.model, 0) + 1
+        self.changed[session_id] = (record, False)
+        return record
+
+    def touch(self, record: Session_Record, now=None) -> None:
+        "Bumps the session's last activity."
+        self._unindex_activity(record)
+        record.last_active = time.time() if now is None else now
+        insort(self.by_activity, record, key=_activity)
+        self.changed[record.session_id] = (record, False)
+
+    def rename(self, record: Session_Record, name: str) -> None:
+        record.name = name
+        self.changed[record.session_id] = (record, False)
+
+    def remove(self, user_id, model, session_id) -> Session_Record | None:
+        user_id = str(user_id)
+        record = self.get(user_id, model, session_id)
+        if record is None: return None
+        models = self.users[user_id]
+        del models[model][session_id]
+        if not models[model]: del models[model]
+        if not models: del self.users[user_id]
+        self._unindex_activity(record)
+        self.model_sessions[record.model] -= 1
+        if not self.model_sessions[record.model]: del self.model_sessions[record.model]
+        self.changed[session_id] = (record, True)
+        return record
+
+    def take_changes(self) -> dict[str, tuple[Session_Record, bool]]:
+        "Returns sessions changed since the last call, {session_id: (record, removed)}, and forgets them."
+        changed, self.changed = self.changed, {}
+        return changed
+
+    def restore_changes(self, changes: dict[str, tuple[Session_Record, bool]]) -> None:
+        "Puts back changes taken with `take_changes` that couldn't be saved. Newer changes of the same sessions win."
+        for session_id, change in changes.items():
+            self.changed.setdefault(session_id, change)
+
+    @staticmethod
+    def journal_entry(record: Session_Record, removed: bool) -> list:
+        "Line of the sessions journal: [user, model, session, name, last modified], or [user, model, session] if removed."
+        if removed: return [record.user_id, record.model, record.session_id]
+        return [record.user_id, record.model, record.session_id, *record.to_json()]
+
+    @staticmethod
+    def apply_journal(data: dict, entries) -> dict:
+        "Applies journal entries to users_sessions.json data, in order."
+        for entry in entries:
+            user_id, model, session_id = entry[:3]
+            if len(entry) > 3:
+                data.setdefault(user_id, {}).setdefault(model, {})[session_id] = entry[3:]
+                continue
+            models = data.get(user_id, {})
+            models.get(model, {}).pop(session_id, None)
+            if model in models and not models[model]: del models[model]
+            if user_id in data and not models: del data[user_id]
+        return data
+
+    def _unindex_activity(self, record: Session_Record) -> None:
+        i = bisect_left(self.by_activity, _activity(record), key=_activity)
+        if i < len(self.by_activity) and self.by_activity[i] is record:
+            del self.by_activity[i]
+
+    # ---------------------------
+    # LOOKUPS
+    # ---------------------------
+    def get(self, user_id, model, session_id) -> Session_Record | None:
+        return self.users.get(str(user_id), {}).get(model, {}).get(session_id)
+
+    def by_number(self, user_id, model, number: int) -> str | None:
+        "Session ID by its 1-based number on the user's list of sessions with the model."
+        sessions = self.users.get(str(user_id), {}).get(model, {})
+        if not 0 < number <= len(sessions): return None
+        return next(islice(sessions, number-1, None))
+
+    def recent(self, limit: int = 10, user_id=None) -> list[Session_Record]:
+        "Most recently active sessions, of everyone or of one user."
+        found = []
+        for record in reversed(self.by_activity):
+            if user_id is None or record.user_id == str(user_id):
+                found.append(record)
+                if len(found) == limit: break
+        return found
+
+    def stale(self, before: float) -> list[Session_Record]:
+        "Sessions inactive since `before` (Unix epoch), oldest first."
+        return self.by_activity[:bisect_left(self.by_activity, (before, ""), key=_activity)]
+
+    def model_counts(self) -> dict[str, int]:
+        return dict(self.model_sessions)
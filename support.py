@@ -1,7 +1,7 @@
-import os, AI, aiofiles, orjson, enum, subprocess, sys
+import os, AI, aiofiles, orjson, enum, subprocess, sys, asyncio, hashlib, tracing, search_index, ollama_supervisor
 from datetime import datetime
 from discord import ButtonStyle, Interaction, Embed, TextStyle, Color, File
-from discord.ui import View, button, Modal, TextInput, Button
+from discord.ui import View, button, Modal, TextInput, Button, DynamicItem
 
 try: import aiofiles
 except ImportError: subprocess.check_call([sys.executable, "-m", "pip", "install", "aiofiles"])
@@ -28,37 +28,41 @@ def set_bot(bot_instance) -> None:
     global _bot
     _bot = bot_instance
 
+def register_persistent_items(bot) -> None:
+    "Registers buttons that keep working after restarts. Call once at startup."
+    bot.add_dynamic_items(*PERSISTENT_ITEMS)
+
 async def log(message: str) -> None:
     "Appends the provided message to the logs file"
     with open(logs_file,"a",encoding="utf-8") as f:
         f.write(str(datetime.now().replace(microsecond=0)) + f" --> {message}\n")
 
-async def get_user_sessions(user_id: int) -> dict[str,dict[str,list[str,str]]]:
+async def get_user_sessions(user_id: int) -> dict[str,dict[str,list[str,int]]]:
     """
     Returns all sessions started by the user. Return form:  
     {"model_name_1": {  
-    \u2003\u2003"session_id_1":["session name","Time when last modified (Unix / POSIX)"]  
+    \u2003\u2003"session_id_1":["session name",Time when last modified (Unix / POSIX)]  
     \u2003\u2003"session_id_2"...  
     \u2003},  
     \u2003"model_name_2"...  
     }  
     If the user has no sessions, returns None.
     """
-    if not os.path.exists(users_sessions_file):
-        async with aiofiles.open(users_sessions_file, "wb") as f:
-            await f.write(orjson.dumps({}, option=orjson.OPT_INDENT_2))
-    
-    async with aiofiles.open(users_sessions_file, "rb") as f:
-        file = await f.read()
-        data = orjson.loads(file)
+    return AI.user_sessions.user_dict(user_id) or None
 
-        try:
-            user_sessions = data[str(user_id)]
-        except KeyError:
-            user_sessions = None
+def mark_degraded(embed: Embed, meta: dict) -> Embed:
+    "Adds a footer to the reply embed if the reply was generated in degraded mode (bot under heavy load)."
+    if meta.get("degraded"):
+        embed.set_footer(text="⚠ Bot is under heavy load, this reply may be shorter than usual.")
+    return embed
 
-        return user_sessions
+async def generation_failed(interaction: Interaction, edit, error: Exception) -> None:
+    "Replaces the Generating... message (`edit` is its edit method) with an error when Ollama couldn't reply."
+    await edit(embed=Embed(description="The AI couldn't reply right now. Try again in a moment, contact the developer if this issue persists.",
+                           color=Color.red()), view=None)
+    await log(f"[ERROR] Reply for {interaction.user.name} failed: {error}")
 
+@tracing.traced("discord.modal")
 async def show_modal(interaction: Interaction, fields: dict[str, list], title: str = "Enter data") -> list[str] | str:
     '''
     Displays a modal using the provided fields.  
@@ -108,7 +112,7 @@ async def split_sessions_into_pages(user_sessions, max_chars=1000):
         model_lines = [f"### {model}:"]
         for session_id, session_data in sessions.items():
             session_name, timestamp = session_data
-            model_lines.append(f"**{len(model_lines)}.** {session_name}   (Last modified: {timestamp})")
+            model_lines.append(f"**{len(model_lines)}.** {session_name}   (Last modified: {AI.discord_ts(timestamp)})")
 
         model_len = sum(len(line) + 1 for line in model_lines)
         if current_len + model_len > max_chars and current_page:
@@ -128,29 +132,20 @@ async def split_sessions_into_pages(user_sessions, max_chars=1000):
 
 async def get_session_id_by_number(user_id: str, model: str, session_num: str) -> str:
     "Returns session id for provided model by its number on a list."
-    async with aiofiles.open(users_sessions_file, "rb") as f:
-        file = await f.read()
-        data = orjson.loads(file)
-
     try:
         session_num = int(session_num)
     except ValueError:
         return "TypeError"
-    
-    if session_num > len(list(data[user_id][model].keys())) or session_num <= 0:
+
+    session_id = AI.user_sessions.by_number(user_id, model, session_num)
+    if session_id is None:
         return "IndexError"
-    
-    ids = list(data[user_id][model].keys())
 
-    return ids[session_num-1]
+    return session_id
 
 async def get_session_name_by_id(user_id: str, model: str, session_id: str) -> str:
     "Returns session name for provided model by its id."
-    async with aiofiles.open(users_sessions_file, "rb") as f:
-        file = await f.read()
-        data = orjson.loads(file)
-
-    return data[str(user_id)][model][session_id][0]
+    return AI.user_sessions.get(user_id, model, session_id).name
 
 async def get_last_message_pair(model: str, session_id: str):
     # Load history
@@ -186,6 +181,53 @@ async def get_last_message_pair(model: str, session_id: str):
 
     return last_user, last_ai
 
+async def get_last_group_turn(session_id: str):
+    "Returns (user message, {character: reply}) of the group's last turn. User message is None for the first turn."
+    _, history = await AI.load_group_async(session_id)
+    starts = [i for i, msg in enumerate(history) if msg["role"] == "user"]
+    while starts and starts[-1] == len(history) - 1:
+        starts.pop()
+    if not starts:
+        return None, {}
+    replies = {msg["name"]: msg["content"] for msg in history[starts[-1]+1:]}
+    return (history[starts[-1]]["content"] if len(starts) > 1 else None), replies
+
+async def group_embeds(replies: dict[str, str], prompt: str | None = None, meta: dict | None = None) -> list[Embed]:
+    "One embed per character's reply, with the character's avatar. The first one shows what they reply to."
+    embeds = []
+    for name, reply in replies.items():
+        content = reply if prompt is None or embeds else f"(Replying to: `{prompt}`)\n\n\n{reply}"
+        embeds.append(Embed(description=content,color=Color.green()).set_author(name=name,icon_url=await get_model_pfp(name)))
+    if embeds and meta: mark_degraded(embeds[-1], meta)
+    return embeds
+
+async def rejoin_session(interaction: Interaction, model: str, session_id: str) -> None:
+    "Sends the last message of the session with Respond_View, so the user can continue it. Terminates empty sessions."
+    if model == AI.GROUP_MODEL:
+        prompt, replies = await get_last_group_turn(session_id)
+        if replies:
+            await interaction.followup.send(embeds=await group_embeds(replies, prompt),ephemeral=True,view=Group_Respond_View(session_id))
+            await log(f"[ACTION] {interaction.user.name} rejoined group session {session_id}")
+            return
+        prompt, ai_reply = None, None
+    else:
+        prompt, ai_reply = await get_last_message_pair(model,session_id)
+
+    if ai_reply is None:
+        await interaction.followup.send(embed=Embed(description=f"Session empty. Terminated automatically. Start another session.", color=Color.red()),ephemeral=True)
+        await AI.end_session(interaction.user.id,model,session_id)
+        await log(f"[ACTION] Autoterminated session {session_id} for {interaction.user.name}")
+    else:
+        if prompt is None:
+            content = ai_reply
+        else:
+            content = f"(Replying to: `{prompt}`)\n\n\n{ai_reply}"
+
+        avatar = await get_model_pfp(model)
+        await interaction.followup.send(embed=Embed(description=content,color=Color.green()).set_author(name=model,icon_url=avatar),ephemeral=True,view=Respond_View(session_id,model))
+        await log(f"[ACTION] {interaction.user.name} rejoined session {session_id}")
+
+@tracing.traced("models.json")
 async def get_model_pfp(model: str) -> str:
     "Returns the model's avatar URL, defined in models.json"
     async with aiofiles.open(models_file, "rb") as f:
@@ -250,8 +292,9 @@ class Page_Types(enum.Enum):
     LAST = 3
 
 class Sessions_View(View):
+    "Persistent view, its buttons carry their own state in custom_id (see PERSISTENT_ITEMS)."
     def __init__(self, pages, no_sessions, current_page=0, user_name="User"):
-        super().__init__(timeout=7200)
+        super().__init__(timeout=None)
         self.pages = pages
         self.no_sessions = no_sessions
         self.current_page = current_page
@@ -260,23 +303,17 @@ class Sessions_View(View):
         page_type = self.get_page_type()
 
         if page_type in [Page_Types.MIDDLE, Page_Types.LAST]:
-            prev_button = Button(label="⪻", style=ButtonStyle.primary, row=0)
-            prev_button.callback = self.previous_callback
-            self.add_item(prev_button)
+            self.add_item(Page_Button(current_page - 1, "⪻"))
 
         if page_type in [Page_Types.FIRST, Page_Types.MIDDLE]:
-            next_button = Button(label="⪼", style=ButtonStyle.primary, row=0)
-            next_button.callback = self.next_callback
-            self.add_item(next_button)
+            self.add_item(Page_Button(current_page + 1, "⪼"))
 
-        if not no_sessions:
-            join_session_button = Button(label="Join Session", style=ButtonStyle.primary, row=2)
-            join_session_button.callback = self.join_session_callback
-            self.add_item(join_session_button)
+        self.add_item(Start_New_Session_Button())
+        self.add_item(Refresh_Button())
 
-            terminate_session_button = Button(label="Terminate Session", style=ButtonStyle.danger, row=2)
-            terminate_session_button.callback = self.terminate_session_callback
-            self.add_item(terminate_session_button)
+        if not no_sessions:
+            self.add_item(Join_Session_Button())
+            self.add_item(Terminate_Session_Button())
 
     def get_page_type(self) -> Page_Types:
         if len(self.pages) == 1:
@@ -288,30 +325,57 @@ class Sessions_View(View):
         else:
             return Page_Types.MIDDLE
 
-    async def previous_callback(self, interaction: Interaction):
-        if self.current_page > 0:
-            self.current_page -= 1
-            await interaction.response.edit_message(embed=self.create_embed(), view=Sessions_View(self.pages, False, self.current_page, self.user_name))
-            await log(f"[ACTION] {interaction.user.name} went back, to page {self.current_page}")
-        else:
-            await interaction.response.defer()
+    def create_embed(self):
+        page_rows = self.pages[self.current_page]
+        embed = Embed(
+            title=f"Sessions of user {self.user_name}",
+            description="\n".join(page_rows),
+            color=Color.blue()
+        )
+        embed.set_footer(text=f"Page {self.current_page+1}/{len(self.pages)}")
+        return embed
 
-    async def next_callback(self, interaction: Interaction):
-        if self.current_page < len(self.pages) - 1:
-            self.current_page += 1
-            await interaction.response.edit_message(embed=self.create_embed(), view=Sessions_View(self.pages, False, self.current_page, self.user_name))
-            await log(f"[ACTION] {interaction.user.name} went forward, to page {self.current_page}")
-        else:
-            await interaction.response.defer()
+    @staticmethod
+    async def for_user(interaction: Interaction, current_page: int = 0) -> "Sessions_View":
+        "Builds the view from the session store, for the user of the interaction."
+        user_sessions = await get_user_sessions(interaction.user.id)
+        pages = await split_sessions_into_pages(user_sessions or {})
+        current_page = min(max(current_page, 0), len(pages) - 1)
+        return Sessions_View(pages, not user_sessions, current_page, interaction.user.display_name)
+
+class Page_Button(DynamicItem[Button], template=r"nbd:sessions:page:(?P<page>\d+)"):
+    def __init__(self, page: int, label: str = "⪼"):
+        super().__init__(Button(label=label, style=ButtonStyle.primary, row=0, custom_id=f"nbd:sessions:page:{page}"))
+        self.page = page
+
+    @classmethod
+    async def from_custom_id(cls, interaction: Interaction, item: Button, match):
+        return cls(int(match["page"]), item.label)
+
+    @tracing.traced_interaction
+    async def callback(self, interaction: Interaction):
+        view = await Sessions_View.for_user(interaction, self.page)
+        await interaction.response.edit_message(embed=view.create_embed(), view=view)
+        await log(f"[ACTION] {interaction.user.name} went to page {view.current_page}")
+
+class Join_Session_Button(DynamicItem[Button], template=r"nbd:sessions:join"):
+    def __init__(self):
+        super().__init__(Button(label="Join Session", style=ButtonStyle.primary, row=2, custom_id="nbd:sessions:join"))
 
-    async def join_session_callback(self, interaction: Interaction):
+    @classmethod
+    async def from_custom_id(cls, interaction: Interaction, item: Button, match):
+        return cls()
+
+    @tracing.traced_interaction
+    async def callback(self, interaction: Interaction):
         model,session_number = await show_modal(interaction,{"Model name": ["(not case sensitive)",1,20],"Session number": ["Enter here...",1,3]},"Enter Session")
         
-        async with aiofiles.open(models_file, "rb") as f:
-            file = await f.read()
-            data = orjson.loads(file)
+        with tracing.span("models.json"):
+            async with aiofiles.open(models_file, "rb") as f:
+                file = await f.read()
+                data = orjson.loads(file)
 
-        model = next((item for item in list(data.keys()) if item.lower() == model.lower()), None)
+        model = next((item for item in list(data.keys()) + [AI.GROUP_MODEL] if item.lower() == model.lower()), None)
         if not model:
             await interaction.followup.send(embed=Embed(description=f"Model does not exist.", color=Color.red()),ephemeral=True)
             return
@@ -324,31 +388,26 @@ class Sessions_View(View):
             await interaction.followup.send(embed=Embed(description=f"Entered value is not a number.", color=Color.red()),ephemeral=True)
             return
         
-        AI.init_sessions()
-        prompt, ai_reply = await get_last_message_pair(model,session_id)
+        await rejoin_session(interaction, model, session_id)
 
-        if ai_reply is None:
-            await interaction.followup.send(embed=Embed(description=f"Session empty. Terminated automatically. Start another session.", color=Color.red()),ephemeral=True)
-            await AI.end_session(interaction.user.id,model,session_id)
-            await log(f"[ACTION] Autoterminated session {session_id} for {interaction.user.name}")
-        else:
-            if prompt is None:
-                content = ai_reply
-            else:
-                content = f"(Replying to: `{prompt}`)\n\n\n{ai_reply}"
+class Terminate_Session_Button(DynamicItem[Button], template=r"nbd:sessions:terminate"):
+    def __init__(self):
+        super().__init__(Button(label="Terminate Session", style=ButtonStyle.danger, row=2, custom_id="nbd:sessions:terminate"))
 
-            avatar = await get_model_pfp(model)
-            await interaction.followup.send(embed=Embed(description=content,color=Color.green()).set_author(name=model,icon_url=avatar),ephemeral=True,view=Respond_View(session_id,model))
-            await log(f"[ACTION] {interaction.user.name} rejoined session {session_id}")
+    @classmethod
+    async def from_custom_id(cls, interaction: Interaction, item: Button, match):
+        return cls()
 
-    async def terminate_session_callback(self, interaction: Interaction):
+    @tracing.traced_interaction
+    async def callback(self, interaction: Interaction):
         model,session_number = await show_modal(interaction,{"Model name": ["(not case sensitive)",1,20],"Session number": ["Enter here...",1,3]},"Terminate Session")
         
-        async with aiofiles.open(models_file, "rb") as f:
-            file = await f.read()
-            data = orjson.loads(file)
+        with tracing.span("models.json"):
+            async with aiofiles.open(models_file, "rb") as f:
+                file = await f.read()
+                data = orjson.loads(file)
 
-        model = next((item for item in list(data.keys()) if item.lower() == model.lower()), None)
+        model = next((item for item in list(data.keys()) + [AI.GROUP_MODEL] if item.lower() == model.lower()), None)
         if not model:
             await interaction.followup.send(embed=Embed(description=f"Model does not exist.", color=Color.red()),ephemeral=True)
             return
@@ -361,29 +420,27 @@ class Sessions_View(View):
             await interaction.followup.send(embed=Embed(description=f"Entered value is not a number.", color=Color.red()),ephemeral=True)
             return
         
-        AI.init_sessions()
         name = await get_session_name_by_id(interaction.user.id, model, session_id)
         await interaction.followup.send(f"# Are you sure?\n(Model: **{model}**, Session name: **{name}**)\nThis can't be undone. You won't be able to go " \
                 "back to this chat ever again.",ephemeral=True,view=Confirmation_View(session_id,model))
         await log(f"[ACTION] {interaction.user.name} entered session termination")
 
-    def create_embed(self):
-        page_rows = self.pages[self.current_page]
-        embed = Embed(
-            title=f"Sessions of user {self.user_name}",
-            description="\n".join(page_rows),
-            color=Color.blue()
-        )
-        embed.set_footer(text=f"Page {self.current_page+1}/{len(self.pages)}")
-        return embed
-    
-    @button(label="Start New Session",style=ButtonStyle.success,row=1)
-    async def start_new_session(self, interaction: Interaction, button: Button):
+class Start_New_Session_Button(DynamicItem[Button], template=r"nbd:sessions:new"):
+    def __init__(self):
+        super().__init__(Button(label="Start New Session", style=ButtonStyle.success, row=1, custom_id="nbd:sessions:new"))
+
+    @classmethod
+    async def from_custom_id(cls, interaction: Interaction, item: Button, match):
+        return cls()
+
+    @tracing.traced_interaction
+    async def callback(self, interaction: Interaction):
         await interaction.response.defer(ephemeral=True)
 
-        async with aiofiles.open(models_file, "rb") as f:
-            file = await f.read()
-            data = orjson.loads(file)
+        with tracing.span("models.json"):
+            async with aiofiles.open(models_file, "rb") as f:
+                file = await f.read()
+                data = orjson.loads(file)
         
         models = []
         for i in range(len(list(data.keys()))):
@@ -393,35 +450,103 @@ class Sessions_View(View):
         await interaction.followup.send(embed=Embed(title="Available models",description=models,color=Color.blue()),ephemeral=True,view=Start_New_Session_View())
         await log(f"[ACTION] Displayed available models to {interaction.user.name}")
 
-    @button(label="Refresh",style=ButtonStyle.secondary,row=1)
-    async def refresh(self, interaction: Interaction, button: Button):
-        async with aiofiles.open(users_sessions_file, "rb") as f:
-            file = await f.read()
-            data = orjson.loads(file)
+class Refresh_Button(DynamicItem[Button], template=r"nbd:sessions:refresh"):
+    def __init__(self):
+        super().__init__(Button(label="Refresh", style=ButtonStyle.secondary, row=1, custom_id="nbd:sessions:refresh"))
 
-        user_sessions = data.get(str(interaction.user.id), {})
-        pages = await split_sessions_into_pages(user_sessions)
+    @classmethod
+    async def from_custom_id(cls, interaction: Interaction, item: Button, match):
+        return cls()
 
-        no_sessions = not bool(user_sessions)
-        await interaction.response.edit_message(embed=Embed(
-            title=f"Sessions of user {self.user_name}",
-            description="\n".join(pages[0]),
-            color=Color.blue()
-        ).set_footer(text=f"Page 1/{len(pages)}"),
-        view=Sessions_View(pages, no_sessions, current_page=0, user_name=self.user_name))
+    @tracing.traced_interaction
+    async def callback(self, interaction: Interaction):
+        view = await Sessions_View.for_user(interaction)
+        await interaction.response.edit_message(embed=view.create_embed(), view=view)
         await log(f"[ACTION] {interaction.user.name} refreshed session view")
 
+SEARCH_QUERY_MAX = 80   # query is kept in the button's custom_id, which Discord limits to 100 characters
+
+def search_digest(results: list[dict]) -> str:
+    "Short fingerprint of the listed results, to notice when a search would now list different sessions."
+    listed = "\n".join(f"{r['model']}/{r['session_id']}/{r['archived']}" for r in results)
+    return hashlib.blake2b(listed.encode(), digest_size=4).hexdigest()
+
+class Search_Results_View(View):
+    "Persistent view, its button carries the query and a digest of the results (see PERSISTENT_ITEMS)."
+    def __init__(self, query: str, results: list[dict]):
+        super().__init__(timeout=None)
+        self.query = query
+        self.results = results
+        self.add_item(Search_Join_Button(query, search_digest(results)))
+
+    def create_embed(self) -> Embed:
+        lines = []
+        for i, result in enumerate(self.results, 1):
+            name = result["name"] or "Unnamed session"
+            state = "  *(terminated)*" if result["archived"] else ""
+            lines.append(f"**{i}.** {result['model']} - {name}{state}")
+        return Embed(title=f"Sessions matching \"{self.query}\"", description="\n".join(lines) or "No sessions found.", color=Color.blue())
+
+class Search_Join_Button(DynamicItem[Button], template=r"nbd:search:(?P<digest>[0-9a-f]{8}):(?P<query>.+)"):
+    def __init__(self, query: str, digest: str):
+        super().__init__(Button(label="Join Session", style=ButtonStyle.primary, row=0, custom_id=f"nbd:search:{digest}:{query}"))
+        self.query = query
+        self.digest = digest
+
+    @classmethod
+    async def from_custom_id(cls, interaction: Interaction, item: Button, match):
+        return cls(match["query"], match["digest"])
+
+    @tracing.traced_interaction
+    async def callback(self, interaction: Interaction):
+        number = await show_modal(interaction,{"Result number": ["Enter here...",1,3]},"Enter Session")
+        # Results are searched again, numbers only mean the same sessions if the list didn't change since
+        results = await asyncio.to_thread(search_index.search, interaction.user.id, self.query)
+        if search_digest(results) != self.digest:
+            view = Search_Results_View(self.query, results)
+            notice = "Results changed since this search, check the numbers and try again."
+            if results:
+                await interaction.followup.send(notice, embed=view.create_embed(), view=view, ephemeral=True)
+            else:
+                await interaction.followup.send(notice, embed=view.create_embed(), ephemeral=True)
+            return
+        try:
+            result = results[int(number)-1]
+            if int(number) <= 0: raise IndexError
+        except ValueError:
+            await interaction.followup.send(embed=Embed(description=f"Entered value is not a number.", color=Color.red()),ephemeral=True)
+            return
+        except IndexError:
+            await interaction.followup.send(embed=Embed(description=f"Entered number is not a valid result number.", color=Color.red()),ephemeral=True)
+            return
+
+        if result["archived"]:
+            await interaction.followup.send(embed=Embed(description=f"This session was terminated, it can't be joined.", color=Color.red()),ephemeral=True)
+            return
+
+        await rejoin_session(interaction, result["model"], result["session_id"])
+
 class Start_New_Session_View(View):
     def __init__(self):
-        super().__init__(timeout=7200)
+        super().__init__(timeout=None)
+        self.add_item(Create_Session_Button())
+
+class Create_Session_Button(DynamicItem[Button], template=r"nbd:models:new"):
+    def __init__(self):
+        super().__init__(Button(label="Start New Session", style=ButtonStyle.success, row=1, custom_id="nbd:models:new"))
+
+    @classmethod
+    async def from_custom_id(cls, interaction: Interaction, item: Button, match):
+        return cls()
 
-    @button(label="Start New Session",style=ButtonStyle.success,row=1)
-    async def start_new_session(self, interaction: Interaction, button: Button):
+    @tracing.traced_interaction
+    async def callback(self, interaction: Interaction):
         model,session_name = await show_modal(interaction,{"Model name": ["(not case sensitive)",1,20],"Session Name": ["Enter here...",1,20]},"Start New Session")
         
-        async with aiofiles.open(models_file, "rb") as f:
-            file = await f.read()
-            data = orjson.loads(file)
+        with tracing.span("models.json"):
+            async with aiofiles.open(models_file, "rb") as f:
+                file = await f.read()
+                data = orjson.loads(file)
 
         model = next((item for item in list(data.keys()) if item.lower() == model.lower()), None)
         if not model:
@@ -429,45 +554,205 @@ class Start_New_Session_View(View):
             return
         
         avatar = await get_model_pfp(model)
-        msg = await interaction.followup.send(embed=Embed(description="Generating...",color=Color.gold()).set_author(name=model,icon_url=avatar),ephemeral=True)
+        with tracing.span("discord.send"):
+            msg = await interaction.followup.send(embed=Embed(description="Generating...",color=Color.gold()).set_author(name=model,icon_url=avatar),ephemeral=True)
         
-        AI.init_sessions()
-        session_id,start_msg = await AI.start_session(interaction.user.id,model,None,session_name)
+        meta = {}
+        try: session_id,start_msg = await AI.start_session(interaction.user.id,model,None,session_name,meta=meta)
+        except ollama_supervisor.Ollama_Unavailable as e:
+            await generation_failed(interaction, msg.edit, e)
+            return
         await add_session_to_db(interaction, session_id)
         
-        await msg.edit(embed=Embed(description=start_msg,color=Color.green()).set_author(name=model,icon_url=avatar),view=Respond_View(session_id,model))
+        with tracing.span("discord.edit"):
+            await msg.edit(embed=mark_degraded(Embed(description=start_msg,color=Color.green()).set_author(name=model,icon_url=avatar),meta),view=Respond_View(session_id,model,meta.get("turn")))
         await log(f"[ACTION] {interaction.user.name} started new session ({session_id})")
 
 class Respond_View(View):
-    def __init__(self,session_id,model):
-        super().__init__(timeout=7200)
+    """
+    Persistent view, its buttons carry model and session in custom_id (see PERSISTENT_ITEMS).
+    `turn` is the number of the turn the message shows, None if unknown (treated as the latest one).
+    """
+    def __init__(self,session_id,model,turn=None):
+        super().__init__(timeout=None)
         self.session_id = session_id
         self.model = model
-    
-    @button(label="Respond",style=ButtonStyle.primary,row=0)
-    async def respond(self, interaction: Interaction, button: Button):
+        self.add_item(Respond_Button(model, session_id))
+        self.add_item(Terminate_Button(model, session_id))
+        self.add_item(Regenerate_Button(model, session_id, turn))
+        self.add_item(Branch_Button(model, session_id, turn))
+
+async def session_exists(interaction: Interaction, model: str, session_id: str) -> bool:
+    "Checks if the session of a clicked button still exists. If not, tells the user."
+    user_sessions = await get_user_sessions(interaction.user.id)
+    if user_sessions and session_id in user_sessions.get(model, {}):
+        return True
+    await interaction.followup.send(embed=Embed(description="This session was terminated. Start another session.", color=Color.red()),ephemeral=True)
+    return False
+
+class Respond_Button(DynamicItem[Button], template=r"nbd:respond:(?P<model>[^:]+):(?P<session>[\w-]+)"):
+    def __init__(self, model: str, session_id: str):
+        super().__init__(Button(label="Respond", style=ButtonStyle.primary, row=0, custom_id=f"nbd:respond:{model}:{session_id}"))
+        self.model = model
+        self.session_id = session_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction: Interaction, item: Button, match):
+        return cls(match["model"], match["session"])
+
+    @tracing.traced_interaction
+    async def callback(self, interaction: Interaction):
         user_response = await show_modal(interaction,{"Your response": ["Enter here...",1,200]},f"Respond to {self.model}")
+        if not await session_exists(interaction, self.model, self.session_id): return
         avatar = await get_model_pfp(self.model)
-        msg = await interaction.followup.send(embed=Embed(description="Generating...",color=Color.gold()).set_author(name=self.model,icon_url=avatar),ephemeral=True)
-        ai_reply = await AI.chat(interaction.user.id, self.model, self.session_id, user_response)
-        await msg.edit(embed=Embed(description=f"(Replying to: `{user_response}`)\n\n\n{ai_reply}",color=Color.green()).set_author(name=self.model,icon_url=avatar),view=self)
+        with tracing.span("discord.send"):
+            msg = await interaction.followup.send(embed=Embed(description="Generating...",color=Color.gold()).set_author(name=self.model,icon_url=avatar),ephemeral=True)
+        meta = {}
+        try: ai_reply = await AI.chat(interaction.user.id, self.model, self.session_id, user_response, meta=meta)
+        except ollama_supervisor.Ollama_Unavailable as e:
+            await generation_failed(interaction, msg.edit, e)
+            return
+        with tracing.span("discord.edit"):
+            await msg.edit(embed=mark_degraded(Embed(description=f"(Replying to: `{user_response}`)\n\n\n{ai_reply}",color=Color.green()).set_author(name=self.model,icon_url=avatar),meta),view=Respond_View(self.session_id,self.model,meta.get("turn")))
         await log(f"[ACTION] {interaction.user.name} responded to AI")
 
-    @button(label="Terminate Session",style=ButtonStyle.danger,row=0)
-    async def terminate_session(self, interaction: Interaction, button: Button):
+class Group_Respond_View(View):
+    "Persistent view of a group scene message (see PERSISTENT_ITEMS)."
+    def __init__(self, session_id):
+        super().__init__(timeout=None)
+        self.session_id = session_id
+        self.add_item(Group_Respond_Button(session_id))
+        self.add_item(Terminate_Button(AI.GROUP_MODEL, session_id))
+
+class Group_Respond_Button(DynamicItem[Button], template=r"nbd:group:respond:(?P<session>[\w-]+)"):
+    def __init__(self, session_id: str):
+        super().__init__(Button(label="Respond", style=ButtonStyle.primary, row=0, custom_id=f"nbd:group:respond:{session_id}"))
+        self.session_id = session_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction: Interaction, item: Button, match):
+        return cls(match["session"])
+
+    @tracing.traced_interaction
+    async def callback(self, interaction: Interaction):
+        user_response = await show_modal(interaction,{"Your response": ["Enter here...",1,200]},"Respond to the group")
+        if not await session_exists(interaction, AI.GROUP_MODEL, self.session_id): return
+        with tracing.span("discord.send"):
+            msg = await interaction.followup.send(embed=Embed(description="Generating...",color=Color.gold()),ephemeral=True)
+        meta = {}
+        try: replies = await AI.group_chat(interaction.user.id, self.session_id, user_response, meta=meta)
+        except ollama_supervisor.Ollama_Unavailable as e:
+            await generation_failed(interaction, msg.edit, e)
+            return
+        with tracing.span("discord.edit"):
+            await msg.edit(embeds=await group_embeds(replies, user_response, meta),view=Group_Respond_View(self.session_id))
+        await log(f"[ACTION] {interaction.user.name} responded to group")
+
+class Terminate_Button(DynamicItem[Button], template=r"nbd:terminate:(?P<model>[^:]+):(?P<session>[\w-]+)"):
+    def __init__(self, model: str, session_id: str):
+        super().__init__(Button(label="Terminate Session", style=ButtonStyle.danger, row=0, custom_id=f"nbd:terminate:{model}:{session_id}"))
+        self.model = model
+        self.session_id = session_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction: Interaction, item: Button, match):
+        return cls(match["model"], match["session"])
+
+    @tracing.traced_interaction
+    async def callback(self, interaction: Interaction):
+        await interaction.response.defer(ephemeral=True)
+        if not await session_exists(interaction, self.model, self.session_id): return
         name = await get_session_name_by_id(interaction.user.id, self.model, self.session_id)
-        await interaction.response.send_message(f"# Are you sure?\n(Model: **{self.model}**, Session name: **{name}**)\nThis can't be undone. You won't be able to go " \
+        await interaction.followup.send(f"# Are you sure?\n(Model: **{self.model}**, Session name: **{name}**)\nThis can't be undone. You won't be able to go " \
                 "back to this chat ever again.",ephemeral=True,view=Confirmation_View(self.session_id,self.model))
         await log(f"[ACTION] {interaction.user.name} entered session termination")
 
+class Regenerate_Button(DynamicItem[Button], template=r"nbd:regen:(?P<model>[^:]+):(?P<session>[\w-]+):(?P<turn>\d*)"):
+    def __init__(self, model: str, session_id: str, turn: int | None = None):
+        super().__init__(Button(label="Regenerate", style=ButtonStyle.secondary, row=1, custom_id=f"nbd:regen:{model}:{session_id}:{turn or ''}"))
+        self.model = model
+        self.session_id = session_id
+        self.turn = turn
+
+    @classmethod
+    async def from_custom_id(cls, interaction: Interaction, item: Button, match):
+        return cls(match["model"], match["session"], int(match["turn"]) if match["turn"] else None)
+
+    @tracing.traced_interaction
+    async def callback(self, interaction: Interaction):
+        avatar = await get_model_pfp(self.model)
+        await interaction.response.edit_message(embed=Embed(description="Regenerating...",color=Color.gold()).set_author(name=self.model,icon_url=avatar),view=None)
+        if not await session_exists(interaction, self.model, self.session_id): return
+
+        history = await AI.load_history_async(self.model, self.session_id)
+        if self.turn is not None and self.turn != len(history) // 2:
+            await interaction.edit_original_response(embed=interaction.message.embeds[0],view=Respond_View(self.session_id,self.model,self.turn))
+            await interaction.followup.send(embed=Embed(description="Only the latest reply can be regenerated. Use \"Branch From Here\" to continue from this one.", color=Color.red()),ephemeral=True)
+            return
+
+        meta = {}
+        try: user_response, ai_reply = await AI.regenerate(interaction.user.id, self.model, self.session_id, meta=meta)
+        except ollama_supervisor.Ollama_Unavailable as e:
+            # The old reply is kept when the new one fails
+            await interaction.edit_original_response(embed=interaction.message.embeds[0],view=Respond_View(self.session_id,self.model,self.turn))
+            await interaction.followup.send(embed=Embed(description="The AI couldn't reply right now. Try again in a moment.", color=Color.red()),ephemeral=True)
+            await log(f"[ERROR] Regeneration for {interaction.user.name} failed: {e}")
+            return
+        if ai_reply is None:
+            await interaction.edit_original_response(embed=Embed(description="There is no reply to regenerate.", color=Color.red()))
+            return
+
+        content = ai_reply if meta["turn"] == 1 else f"(Replying to: `{user_response}`)\n\n\n{ai_reply}"
+        await interaction.edit_original_response(embed=mark_degraded(Embed(description=content,color=Color.green()).set_author(name=self.model,icon_url=avatar),meta),view=Respond_View(self.session_id,self.model,meta["turn"]))
+        await log(f"[ACTION] {interaction.user.name} regenerated reply in session {self.session_id}")
+
+class Branch_Button(DynamicItem[Button], template=r"nbd:branch:(?P<model>[^:]+):(?P<session>[\w-]+):(?P<turn>\d*)"):
+    def __init__(self, model: str, session_id: str, turn: int | None = None):
+        super().__init__(Button(label="Branch From Here", style=ButtonStyle.secondary, row=1, custom_id=f"nbd:branch:{model}:{session_id}:{turn or ''}"))
+        self.model = model
+        self.session_id = session_id
+        self.turn = turn
+
+    @classmethod
+    async def from_custom_id(cls, interaction: Interaction, item: Button, match):
+        return cls(match["model"], match["session"], int(match["turn"]) if match["turn"] else None)
+
+    @tracing.traced_interaction
+    async def callback(self, interaction: Interaction):
+        session_name = await show_modal(interaction,{"Branch Name": ["Enter here...",1,20]},"Branch From Here")
+        if not await session_exists(interaction, self.model, self.session_id): return
+
+        branch_id = await AI.branch_session(interaction.user.id, self.model, self.session_id, self.turn, session_name)
+        if branch_id is None:
+            await interaction.followup.send(embed=Embed(description="There is nothing to branch from yet.", color=Color.red()),ephemeral=True)
+            return
+        await add_session_to_db(interaction, branch_id)
+
+        # Branch continues from the message the button was on
+        embed = interaction.message.embeds[0].copy()
+        embed.set_footer(text=f"Branch: {session_name}")
+        await interaction.followup.send(embed=embed,ephemeral=True,view=Respond_View(branch_id,self.model,self.turn))
+        await log(f"[ACTION] {interaction.user.name} branched session {self.session_id} into {branch_id}")
+
 class Confirmation_View(View):
     def __init__(self, session_id, model):
-        super().__init__(timeout=7200)
+        super().__init__(timeout=None)
         self.session_id = session_id
         self.model = model
-    
-    @button(label="I'm Sure",style=ButtonStyle.danger,row=0)
-    async def im_sure(self, interaction: Interaction, button: Button):
+        self.add_item(Confirm_Terminate_Button(model, session_id))
+
+class Confirm_Terminate_Button(DynamicItem[Button], template=r"nbd:confirm:(?P<model>[^:]+):(?P<session>[\w-]+)"):
+    def __init__(self, model: str, session_id: str):
+        super().__init__(Button(label="I'm Sure", style=ButtonStyle.danger, row=0, custom_id=f"nbd:confirm:{model}:{session_id}"))
+        self.model = model
+        self.session_id = session_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction: Interaction, item: Button, match):
+        return cls(match["model"], match["session"])
+
+    @tracing.traced_interaction
+    async def callback(self, interaction: Interaction):
         await interaction.response.defer()
         
         msg = await interaction.followup.send(embed=Embed(description="Terminating...",color=Color.gold()),ephemeral=True)
@@ -531,4 +816,9 @@ class Install_View(View):
             url=app_install_url,
             row=0
         )
-        self.add_item(install_button)
\ No newline at end of file
+        self.add_item(install_button)
+
+# Buttons resolved from their custom_id, so no view objects are kept per sent message
+PERSISTENT_ITEMS = (Page_Button, Join_Session_Button, Terminate_Session_Button, Start_New_Session_Button, Refresh_Button,
+                    Create_Session_Button, Respond_Button, Terminate_Button, Regenerate_Button, Branch_Button, Confirm_Terminate_Button,
+                    Group_Respond_Button, Search_Join_Button)
\ No newline at end of file
@@ -0,0 +1,200 @@
+"""
+Lightweight request tracing.
+
+Each Discord interaction gets a trace ID, kept in a context variable so it follows the request through awaits,
+tasks and asyncio.to_thread. Timed spans of a sampled trace are written to traces/spans.jsonl (rotated).
+
+    python tracing.py                      last 10 traces
+    python tracing.py --trace 3f2a9c...    one trace
+    python tracing.py --user 1234 --last 5 latest traces of a user (ID or name)
+"""
+import os, sys, time, random, logging, functools, threading, contextvars, inspect, argparse, subprocess
+from logging.handlers import RotatingFileHandler
+from contextlib import contextmanager
+from datetime import datetime
+
+try: import orjson
+except ImportError:
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "orjson"])
+    import orjson
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TRACES_DIR = os.path.join(BASE_DIR, "traces")
+TRACE_FILE = os.path.join(TRACES_DIR, "spans.jsonl")
+
+SAMPLE_RATE = 0.1           # share of interactions traced
+MAX_FILE_BYTES = 20 * 1024**2
+BACKUP_FILES = 5            # spans.jsonl.1 ... .5, oldest dropped
+
+class Span_Context:
+    __slots__ = ("trace_id", "span_id", "user")
+
+    def __init__(self, trace_id: str, span_id: str | None, user: str | None):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.user = user
+
+_current: contextvars.ContextVar[Span_Context | None] = contextvars.ContextVar("nbd_trace", default=None)
+_writer: logging.Logger | None = None
+_writer_lock = threading.Lock()
+
+def _new_id() -> str:
+    return os.urandom(8).hex()
+
+def _get_writer() -> logging.Logger:
+    "Sets up the span file logger on first use. Under a lock, so spans of threads starting at once get one handler."
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            os.makedirs(TRACES_DIR, exist_ok=True)
+            handler = RotatingFileHandler(TRACE_FILE, maxBytes=MAX_FILE_BYTES, backupCount=BACKUP_FILES, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            writer = logging.getLogger("nbd.trace")
+            writer.propagate = False
+            writer.setLevel(logging.INFO)
+            writer.addHandler(handler)
+            _writer = writer
+    return _writer
+
+def _write(record: dict) -> None:
+    (_writer or _get_writer()).info(orjson.dumps(record, default=str).decode())
+
+def current_trace_id() -> str | None:
+    ctx = _current.get()
+    return ctx.trace_id if ctx else None
+
+# ---------------------------
+# SPANS
+# ---------------------------
+@contextmanager
+def start_trace(name: str, user=None, sampled: bool | None = None, **attrs):
+    "Starts a new trace with `name` as its root span. Yields the span's attributes dict, which may be added to."
+    if sampled is None: sampled = random.random() < SAMPLE_RATE
+    token = _current.set(Span_Context(_new_id(), None, None if user is None else str(user)) if sampled else None)
+    try:
+        with span(name, **attrs) as span_attrs:
+            yield span_attrs
+    finally:
+        _current.reset(token)
+
+@contextmanager
+def span(name: str, **attrs):
+    "Times the block as a child of the current span. Does nothing outside a sampled trace."
+    parent = _current.get()
+    if parent is None:
+        yield attrs
+        return
+    ctx = Span_Context(parent.trace_id, _new_id(), parent.user)
+    token = _current.set(ctx)
+    start, started = time.time(), time.perf_counter()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs["error"] = type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        _write({"trace": ctx.trace_id, "span": ctx.span_id, "parent": parent.span_id, "name": name, "start": start,
+                "ms": round((time.perf_counter() - started) * 1000, 3), "user": ctx.user, **attrs})
+
+def record(name: str, start: float, ms: float, **attrs) -> None:
+    "Adds a span timed elsewhere (e.g. by Ollama) as a child of the current span. `start` is Unix epoch."
+    parent = _current.get()
+    if parent is None: return
+    _write({"trace": parent.trace_id, "span": _new_id(), "parent": parent.span_id, "name": name, "start": start,
+            "ms": round(ms, 3), "user": parent.user, **attrs})
+
+def traced(name: str | None = None):
+    "Decorator, runs the (sync or async) function in a span named `name` (default: module.function)."
+    def decorate(fn):
+        span_name = name or f"{fn.__module__}.{fn.__qualname__}"
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with span(span_name):
+                    return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def traced_interaction(fn):
+    "Decorator for `callback(self, interaction, ...)` of views and commands, each call starts a trace."
+    @functools.wraps(fn)
+    async def wrapper(self, interaction, *args, **kwargs):
+        with start_trace(type(self).__name__ if fn.__name__ == "callback" else fn.__qualname__,
+                         user=interaction.user.id, user_name=interaction.user.name):
+            return await fn(self, interaction, *args, **kwargs)
+    return wrapper
+
+# ---------------------------
+# VIEWER
+# ---------------------------
+def load_spans() -> dict[str, list[dict]]:
+    "Reads all span files. Returns {trace ID: spans}."
+    traces = {}
+    paths = [f"{TRACE_FILE}.{i}" for i in range(BACKUP_FILES, 0, -1)] + [TRACE_FILE]
+    for path in paths:
+        if not os.path.exists(path): continue
+        with open(path, "rb") as f:
+            for line in f:
+                try: record = orjson.loads(line)
+                except orjson.JSONDecodeError: continue
+                traces.setdefault(record["trace"], []).append(record)
+    return traces
+
+def waterfall(spans: list[dict], width: int = 40) -> str:
+    "Renders a trace as an indented tree of spans with bars positioned on the trace's timeline."
+    children = {}
+    for s in spans: children.setdefault(s["parent"], []).append(s)
+    ids = {s["span"] for s in spans}
+    roots = [s for s in spans if s["parent"] not in ids]
+    begin = min(s["start"] for s in spans)
+    end = max(s["start"] + s["ms"] / 1000 for s in spans)
+    total = max(end - begin, 1e-6)
+
+    root = min(roots, key=lambda s: s["start"])
+    user = root.get("user_name") or root.get("user") or "-"
+    lines = [f"Trace {root['trace']}  {root['name']}  user {user}  "
+             f"{datetime.fromtimestamp(begin).strftime('%Y-%m-%d %H:%M:%S')}  {total * 1000:.1f} ms",
+             f"{'offset ms':>10}{'ms':>10}  "]
+
+    def add(s, depth):
+        offset = s["start"] - begin
+        left = int(offset / total * width)
+        bar = " " * left + "█" * max(int(s["ms"] / 1000 / total * width), 1)
+        extra = {k: v for k, v in s.items() if k not in ("trace", "span", "parent", "name", "start", "ms", "user", "user_name")}
+        details = "  " + " ".join(f"{k}={v}" for k, v in extra.items()) if extra else ""
+        lines.append(f"{offset * 1000:>10.1f}{s['ms']:>10.1f}  {bar:<{width}}  {'  ' * depth}{s['name']}{details}")
+        for child in sorted(children.get(s["span"], []), key=lambda c: c["start"]):
+            add(child, depth + 1)
+
+    for r in sorted(roots, key=lambda s: s["start"]):
+        add(r, 0)
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="NBD AI trace viewer")
+    parser.add_argument("--trace", help="trace ID (or its start)")
+    parser.add_argument("--user", help="user ID or name")
+    parser.add_argument("--last", type=int, default=10, help="how many of the latest matching traces to show (default: 10)")
+    args = parser.parse_args()
+
+    traces = load_spans()
+    if args.trace:
+        found = [spans for trace_id, spans in traces.items() if trace_id.startswith(args.trace)]
+    else:
+        found = list(traces.values())
+        if args.user:
+            found = [spans for spans in found if any(args.user in (str(s.get("user")), s.get("user_name")) for s in spans)]
+        found = sorted(found, key=lambda spans: min(s["start"] for s in spans))[-args.last:]
+    if not found:
+        print("No matching traces.")
+        return
+    print("\n\n".join(waterfall(spans) for spans in found))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""
+Columnar usage events.
+
+Events are appended to in-memory column buffers (array.array) and flushed to one raw file per column in a segment
+directory per UTC day: usage/<YYYY-MM-DD>/<column>.bin. Reports memory-map the columns with NumPy, so months of
+events are read in seconds instead of parsing logs.txt.
+
+    python usage_store.py                      report of the last 30 days
+    python usage_store.py --since 2026-01-01 --until 2026-02-01
+"""
+import os, sys, time, array, atexit, asyncio, hashlib, threading, argparse, subprocess, orjson
+from datetime import datetime, timezone, timedelta
+
+try: import numpy as np
+except ImportError:
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "numpy"])
+    import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+USAGE_DIR = os.path.join(BASE_DIR, "usage")
+MODEL_IDS_FILE = os.path.join(USAGE_DIR, "models.json")
+KEY_FILE = os.path.join(USAGE_DIR, "user_key.bin")     # secret of the user hashes, never share it with the events
+
+FLUSH_EVENTS = 4096     # buffered events that trigger a flush, otherwise flushed by AI's write-behind flusher
+
+# column: (array typecode, NumPy dtype)
+COLUMNS = {
+    "ts": ("d", np.float64),            # Unix epoch, when the event ended
+    "user": ("Q", np.uint64),           # keyed hash of the Discord user ID
+    "model": ("H", np.uint16),          # ID from usage/models.json
+    "event": ("B", np.uint8),
+    "prompt_tokens": ("I", np.uint32),
+    "reply_tokens": ("I", np.uint32),
+    "latency_ms": ("f", np.float32),    # from request to reply, queue included
+    "bytes": ("I", np.uint32)           # UTF-8 size of the user message and reply
+}
+
+# Event types
+SESSION_START = 0
+REPLY = 1
+REGENERATE = 2
+GROUP_REPLY = 3
+BRANCH = 4
+SESSION_END = 5
+EVENT_NAMES = {SESSION_START: "session start", REPLY: "reply", REGENERATE: "regenerate", GROUP_REPLY: "group reply",
+               BRANCH: "branch", SESSION_END: "session end"}
+GENERATION_EVENTS = (REPLY, REGENERATE, GROUP_REPLY)
+
+def user_hash(user_id, key: bytes) -> int:
+    "Users are stored as a hash keyed with a local secret, so known Discord IDs can't be matched against the event files."
+    return int.from_bytes(hashlib.blake2b(str(user_id).encode(), digest_size=8, key=key).digest(), "little")
+
+def _day(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d")
+
+def _new_buffers() -> dict[str, array.array]:
+    return {name: array.array(code) for name, (code, _) in COLUMNS.items()}
+
+class Usage_Store:
+    """
+    `record` runs on the event loop for every request, so it only appends to memory: the user key and the model
+    table are read when the store is made, new ones are written by `flush`. Flushing swaps the buffers out under
+    the lock and writes them outside it, so `record` never waits on the disk.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()           # buffers, held only for in-memory work
+        self._write_lock = threading.Lock()     # one flush writes at a time, in order
+        self._buffers = _new_buffers()
+        self._buffer_day = None
+        self._full = []                         # [(day, buffers)] swapped out, waiting for a flush
+        self._aligned = set()                   # segments whose columns were checked to have the same row count
+        self._tasks = set()
+        self._model_ids = orjson.loads(open(MODEL_IDS_FILE, "rb").read()) if os.path.exists(MODEL_IDS_FILE) else {}
+        self._models_saved = True
+        if os.path.exists(KEY_FILE):
+            with open(KEY_FILE, "rb") as f: self._key, self._key_saved = f.read(), True
+        else:
+            self._key, self._key_saved = os.urandom(32), False
+
+    def record(self, event: int, user_id, model: str, prompt_tokens: int = 0, reply_tokens: int = 0,
+               latency_ms: float = 0.0, size: int = 0, ts: float | None = None) -> None:
+        ts = time.time() if ts is None else ts
+        user = user_hash(user_id, self._key)
+        with self._lock:
+            day = _day(ts)
+            if day != self._buffer_day and len(self._buffers["ts"]):
+                self._full.append((self._buffer_day, self._buffers))
+                self._buffers = _new_buffers()
+            self._buffer_day = day
+            if model not in self._model_ids:
+                self._model_ids[model] = len(self._model_ids)
+                self._models_saved = False
+            row = (ts, user, self._model_ids[model], event, prompt_tokens or 0, reply_tokens or 0, latency_ms, size)
+            for buffer, value in zip(self._buffers.values(), row):
+                buffer.append(value)
+            if len(self._buffers["ts"]) >= FLUSH_EVENTS:
+                self._full.append((day, self._buffers))
+                self._buffers = _new_buffers()
+            due = bool(self._full)
+        if due: self._flush_soon()
+
+    def _flush_soon(self) -> None:
+        "Flushes in a worker thread, or right away when there's no event loop to keep free."
+        try: loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        task = loop.create_task(asyncio.to_thread(self.flush))
+        self._tasks.add(task)
+        task.add_done_callback(self._flushed)
+
+    def _flushed(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            # The events are kept and retried by the next flush
+            print(f"[ERROR] Couldn't save usage events: {type(task.exception()).__name__}: {task.exception()}", file=sys.stderr)
+
+    def flush(self) -> None:
+        "Appends buffered events to their day's segment. Blocks on disk writes, call it from a worker thread."
+        with self._write_lock:
+            with self._lock:
+                pending = self._full
+                if len(self._buffers["ts"]): pending.append((self._buffer_day, self._buffers))
+                self._full, self._buffers = [], _new_buffers()
+                model_ids = None if self._models_saved else dict(self._model_ids)
+                self._models_saved = True
+            try:
+                if pending or model_ids is not None: os.makedirs(USAGE_DIR, exist_ok=True)
+                # Key and model table go first, so no written event refers to something missing on disk
+                if pending and not self._key_saved:
+                    with open(KEY_FILE, "wb") as f: f.write(self._key)
+                    self._key_saved = True
+                if model_ids is not None:
+                    with open(MODEL_IDS_FILE, "wb") as f:
+                        f.write(orjson.dumps(model_ids, option=orjson.OPT_INDENT_2))
+                while pending:
+                    self._write_segment(*pending[0])
+                    pending.pop(0)
+            except OSError:
+                with self._lock:
+                    self._full[:0] = pending
+                    if model_ids is not None: self._models_saved = False
+                raise
+
+    def _write_segment(self, day: str, buffers: dict[str, array.array]) -> None:
+        segment = os.path.join(USAGE_DIR, day)
+        os.makedirs(segment, exist_ok=True)
+        if segment not in self._aligned:
+            align_segment(segment)
+            self._aligned.add(segment)
+        try:
+            for name, buffer in buffers.items():
+                with open(os.path.join(segment, f"{name}.bin"), "ab") as f:
+                    buffer.tofile(f)
+        except OSError:
+            # Some columns may have the rows already, align again before the buffers are retried
+            self._aligned.discard(segment)
+            raise
+
+def segment_rows(path: str) -> int:
+    "Rows all columns of the segment have. A column cut short by a crash limits all of them to its length."
+    sizes = []
+    for name, (_, dtype) in COLUMNS.items():
+        column = os.path.join(path, f"{name}.bin")
+        sizes.append(os.path.getsize(column) // np.dtype(dtype).itemsize if os.path.exists(column) else 0)
+    return min(sizes)
+
+def align_segment(path: str) -> None:
+    "Truncates the segment's columns to their common row count, so rows appended next line up in all of them."
+    rows = segment_rows(path)
+    for name, (_, dtype) in COLUMNS.items():
+        column = os.path.join(path, f"{name}.bin")
+        if os.path.exists(column) and os.path.getsize(column) != rows * np.dtype(dtype).itemsize:
+            os.truncate(column, rows * np.dtype(dtype).itemsize)
+
+store = Usage_Store()
+
+def use_dir(path: str) -> None:
+    "Keeps usage events in `path` instead of usage/. Call before anything is recorded."
+    global USAGE_DIR, MODEL_IDS_FILE, KEY_FILE, store
+    USAGE_DIR = path
+    MODEL_IDS_FILE = os.path.join(USAGE_DIR, "models.json")
+    KEY_FILE = os.path.join(USAGE_DIR, "user_key.bin")
+    store = Usage_Store()
+
+atexit.register(lambda: store.flush())
+
+# ---------------------------
+# REPORTS
+# ---------------------------
+def load_segment(path: str) -> dict[str, np.ndarray]:
+    "Memory-maps the segment's columns, up to the rows all of them have."
+    rows = segment_rows(path)
+    return {name: np.memmap(os.path.join(path, f"{name}.bin"), dtype=dtype, mode="r", shape=(rows,)) if rows else np.empty(0, dtype)
+            for name, (_, dtype) in COLUMNS.items()}
+
+def load_range(since: str, until: str) -> tuple[list[tuple[str, dict]], dict[str, np.ndarray]]:
+    "Segments of days since <= day < until. Returns ([(day, columns)], all columns concatenated)."
+    days = []
+    if os.path.isdir(USAGE_DIR):
+        for day in sorted(os.listdir(USAGE_DIR)):
+            path = os.path.join(USAGE_DIR, day)
+            if since <= day < until and os.path.isdir(path) and os.path.exists(os.path.join(path, "ts.bin")):
+                days.append((day, load_segment(path)))
+    columns = {name: np.concatenate([cols[name] for _, cols in days]) if days else np.empty(0, dtype)
+               for name, (_, dtype) in COLUMNS.items()}
+    return days, columns
+
+def peak_concurrency(starts: np.ndarray, ends: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    "Returns (hours as epoch // 3600, most generations running at once in that hour)."
+    if not len(starts): return np.empty(0, np.int64), np.empty(0, np.int64)
+    times = np.concatenate([starts, ends])
+    deltas = np.concatenate([np.ones(len(starts), np.int64), -np.ones(len(ends), np.int64)])
+    order = np.lexsort((deltas, times))  # ends before starts at the same moment
+    running = np.cumsum(deltas[order])
+    hours = (times[order] // 3600).astype(np.int64)
+    bounds = np.flatnonzero(np.diff(hours)) + 1
+    starts_at = np.concatenate([[0], bounds])
+    return hours[starts_at], np.maximum.reduceat(running, starts_at)
+
+def report(since: str, until: str) -> dict:
+    days, cols = load_range(since, until)
+    model_names = {v: k for k, v in (orjson.loads(open(MODEL_IDS_FILE, "rb").read()) if os.path.exists(MODEL_IDS_FILE) else {}).items()}
+    result = {"since": since, "until": until, "events": int(len(cols["ts"]))}
+
+    result["daily_active_users"] = {day: int(len(np.unique(c["user"]))) for day, c in days}
+
+    generation = np.isin(cols["event"], GENERATION_EVENTS)
+    latency = cols["latency_ms"][generation]
+    result["latency_ms"] = {f"p{p}": round(float(v), 1) for p, v in zip((50, 90, 99), np.percentile(latency, (50, 90, 99)))} if len(latency) else {}
+
+    models = cols["model"][generation]
+    replies = np.bincount(models)
+    prompt_tokens = np.bincount(models, weights=cols["prompt_tokens"][generation])
+    reply_tokens = np.bincount(models, weights=cols["reply_tokens"][generation])
+    busy = np.bincount(models, weights=latency)
+    per_model = {}
+    for model_id in np.flatnonzero(replies):
+        model_latency = latency[models == model_id]
+        per_model[model_names.get(int(model_id), str(model_id))] = {
+            "replies": int(replies[model_id]), "prompt_tokens": int(prompt_tokens[model_id]), "reply_tokens": int(reply_tokens[model_id]),
+            "busy_hours": round(float(busy[model_id]) / 3_600_000, 2), "p90_latency_ms": round(float(np.percentile(model_latency, 90)), 1)}
+    result["models"] = per_model
+
+    ends = cols["ts"][generation]
+    hours, peaks = peak_concurrency(ends - latency.astype(np.float64) / 1000, ends)
+    if len(peaks):
+        result["peak_concurrency"] = int(peaks.max())
+        # Typical load per hour of day (UTC): mean of each day's peak in that hour
+        hour_of_day = hours % 24
+        result["peak_concurrency_by_hour"] = {f"{h:02d}:00": round(float(peaks[hour_of_day == h].mean()), 2) for h in np.unique(hour_of_day)}
+    return result
+
+def print_report(r: dict) -> None:
+    print(f"Usage {r['since']} .. {r['until']}  ({r['events']} events)\n")
+    print("Daily active users:")
+    for day, users in r["daily_active_users"].items(): print(f"  {day}  {users}")
+    if r["latency_ms"]:
+        print("\nReply latency: " + "  ".join(f"{k} {v} ms" for k, v in r["latency_ms"].items()))
+    print(f"\n{'model':<20}{'replies':>10}{'prompt tok':>14}{'reply tok':>12}{'busy h':>10}{'p90 ms':>10}")
+    for model, m in sorted(r["models"].items(), key=lambda item: -item[1]["replies"]):
+        print(f"{model:<20}{m['replies']:>10}{m['prompt_tokens']:>14}{m['reply_tokens']:>12}{m['busy_hours']:>10}{m['p90_latency_ms']:>10}")
+    if "peak_concurrency" in r:
+        print(f"\nPeak concurrent generations: {r['peak_concurrency']}")
+        print("Average hourly peak (UTC): " + "  ".join(f"{h} {v}" for h, v in r["peak_concurrency_by_hour"].items()))
+
+def main():
+    today = datetime.now(timezone.utc).date()
+    parser = argparse.ArgumentParser(description="NBD AI usage report")
+    parser.add_argument("--since", default=str(today - timedelta(days=30)), help="first day, YYYY-MM-DD (default: 30 days ago)")
+    parser.add_argument("--until", default=str(today + timedelta(days=1)), help="day after the last one, YYYY-MM-DD (default: tomorrow)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    r = report(args.since, args.until)
+    if args.json: print(orjson.dumps(r, option=orjson.OPT_INDENT_2).decode())
+    else: print_report(r)
+
+if __name__ == "__main__":
+    main()